@@ -1,67 +1,53 @@
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import streamlit as st
-from langchain_community.vectorstores import FAISS
-from langchain_core.documents import Document
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_google_genai import ChatGoogleGenerativeAI
 
+import utils.journal_shards as journal_shards
 from diary_analytics import generate_analytics_new_entry
 from new_diary_entry import *
-from old_diary_entries import old_diary_entries
+from utils.bulk_indexer import bulk_index_entries
 from utils.llm_utils import *
+from utils.prompt_assembler import assemble_chatbot_system_prompt
 from utils.prompt_templates import *
+from utils.user_partitions import current_user_partition, get_user_partition
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+COMPLETION_MESSAGE = (
+    "Thanks for sharing! You've finished your reflection and submitted a new diary entry."
+)
 
-def add_old_diary_entries_to_db(old_diary_entries: Dict):
+# runs llm calls that are kept off the critical path of a chat turn
+_background_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def add_old_diary_entries_to_db(old_diary_entries=None, partition=None):
     """
-    Add old diary entries to the vector store
+    Add old diary entries to the vector store, defaults to every entry in the journal store.
+    partition is the UserPartition to index, the default user when not given. See
+    utils.bulk_indexer for how entries are embedded and checkpointed.
     """
     try:
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-        list_of_documents = []
-
-        for _, diary_entry in old_diary_entries.iterrows():
-            list_of_documents.append(
-                Document(
-                    page_content=diary_entry["entry_content"],
-                    metadata=dict(
-                        entry=diary_entry["entry"],
-                        current_state=diary_entry["current_state"],
-                        desired_state=diary_entry["desired_state"],
-                        date=diary_entry["entry_date"],
-                        title=diary_entry["entry_title"],
-                        mental_tendencies=diary_entry["mental_tendencies"],
-                        emotions=diary_entry["emotions"],
-                        key_topics=diary_entry["key_topics"],
-                        reflection_questions=diary_entry["reflection_questions"],
-                    ),
-                )
-            )
-        vector_store = FAISS.from_documents(list_of_documents, embeddings)
-        vector_store.save_local("faiss_index")
-        return {
-            "status": "success",
-            "message": "Old diary entries added to the vector store successfully.",
-        }
+        return bulk_index_entries(partition=partition, entries=old_diary_entries)
     except Exception as e:
         return {"status": "failure", "message": f"An error occurred: {str(e)}"}
 
 
-def generate_initial_prompts():
+def generate_initial_prompts(partition=None):
     """
     Generates starter prompts based on past diary entries
     """
+    partition = partition or get_user_partition()
     model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector_store = FAISS.load_local(
-        "faiss_index", embeddings=embeddings, allow_dangerous_deserialization=True
+    past_entries, _ = journal_shards.search_shards(
+        " ", num_of_docs=5, index_path=partition.index_path
     )
-    past_entries = vector_store.search(" ", search_type="similarity", k=5)
     context = "\n".join(entry.page_content for entry in past_entries)
 
     prompt_template = f"""
@@ -79,86 +65,180 @@ def generate_initial_prompts():
 
 
 def get_llm_chat_instance(system_prompt, previous_chat_model=None):
-    chat_history = []
+    """
+    Starts a conversation with system_prompt, or swaps the system prompt of previous_chat_model
+    in place so its history is kept without being copied
+    """
     if previous_chat_model:
-        chat_history = previous_chat_model.history[2:]
-
-    model = get_llm_instance()
-    chat = model.start_chat(
-        history=[
-            {"role": "user", "parts": [system_prompt]},
-            {"role": "model", "parts": ["Understood."]},
-        ]
-        + chat_history
-    )
+        previous_chat_model.set_system_prompt(system_prompt)
+        return previous_chat_model
 
-    return chat
+    return ConversationSession(system_prompt)
 
 
-def chat_with_user(user_msg):
+def get_steering_branch(conversation_labels):
     """
-    Takes a user message, creates a response. Will add logic steps to steer the conversation where needed.
+    Which piece of information the therapist should ask for next, or "complete" once the
+    conversation labels are all filled in
     """
-    # To do: to explore streaming
-    # - https://ai.google.dev/gemini-api/docs/get-started/tutorial?lang=python
-    # - https://docs.streamlit.io/develop/api-reference/write-magic/st.write_stream
+    if not conversation_labels.emotions or conversation_labels.emotions == ["None"]:
+        return "emotions"
+    if not conversation_labels.current_state or conversation_labels.current_state == "None":
+        return "current_state"
+    if not conversation_labels.desired_state or conversation_labels.desired_state == "None":
+        return "desired_state"
+    return "complete"
+
 
+def get_steering_system_prompt(steering_branch, chat_history):
+    """
+    Assembles the system prompt for the steering branch within the prompt token budget, the
+    tokens used per section are kept in st.session_state["prompt_token_usage"]
+    """
+    partition = current_user_partition()
+    sahha_prompt, _ = get_sahha_insights(1, partition.sahha_user_id)
+    if steering_branch == "current_state":
+        new_sys_prompt, usage = assemble_chatbot_system_prompt(
+            additional_info="- The current state (or real outcome) that this person experienced",
+            sahha_insights=sahha_prompt,
+            similar_issues=get_db_context(chat_history, index_path=partition.index_path),
+        )
+    elif steering_branch == "desired_state":
+        new_sys_prompt, usage = assemble_chatbot_system_prompt(
+            additional_info="- The desired state (or desired outcome, expectation) that this person expected.",
+            sahha_insights=sahha_prompt,
+            similar_issues=get_db_context(chat_history, index_path=partition.index_path),
+        )
+    else:
+        new_sys_prompt, usage = assemble_chatbot_system_prompt(sahha_insights=sahha_prompt)
+
+    st.session_state["prompt_token_usage"] = usage
+    return new_sys_prompt
+
+
+def finalize_diary_entry(chat_model, conversation_labels):
+    """
+    Summarizes the conversation into a new diary entry and adds it to the vectorstore
+    """
+    diary_entry_summary = summarize_new_entry(chat_model)
+    output_dict = prepare_output_dict(conversation_labels, diary_entry_summary)
+    st.session_state["output_complete_flag"] = "True"
+    generate_analytics_new_entry(output_dict, current_user_partition())
+    return output_dict
+
+
+def chat_with_user(user_msg, full_extraction=False):
+    """
+    Takes a user message, creates a response. Will add logic steps to steer the conversation where needed.
+
+    The reply is generated speculatively with the current system prompt while the conversation
+    labels are extracted in the background. The reply is only re-sent with a new system prompt
+    when the labels move the conversation to a different steering branch.
+    """
     chat_model = st.session_state["chat_model"]
-    chat_history = get_user_inputs_from_chat_model(chat_model, user_msg).strip()
 
-    conversation_labels = DeepDiveConversationLabels()
+    if not has_previous_user_msgs(chat_model):
+        response = chat_model.send_message(user_msg)
+        return response, DeepDiveConversationLabels().model_dump()
+
+    labels_future = submit_label_extraction(chat_model, user_msg, full_extraction)
+    response = chat_model.send_message(user_msg)
+    conversation_labels = labels_future.result()
+    st.session_state["label_state"] = conversation_labels
 
-    if len(chat_history.strip()) > len(user_msg.strip()):
-        # currently we are running this sequentially. Potentially to run this in the "background"?
-        conversation_labels = extract_info_from_conversation(chat_history)
+    steering_branch = get_steering_branch(conversation_labels)
+    previous_steering_branch = st.session_state.get("steering_branch") or "emotions"
+    st.session_state["steering_branch"] = steering_branch
 
-        if not conversation_labels.emotions or conversation_labels.emotions == ["None"]:
-            new_sys_prompt = get_chatbot_system_prompt(sahha_insights=get_sahha_insights(1, 1))
+    if steering_branch == "complete":
+        # drop the speculative reply, the entry is summarized from the conversation before it
+        chat_model.rewind()
+        return COMPLETION_MESSAGE, finalize_diary_entry(chat_model, conversation_labels)
 
-            st.session_state["chat_model"] = get_llm_chat_instance(new_sys_prompt, chat_model)
-            chat_model = st.session_state["chat_model"]
+    if steering_branch != previous_steering_branch:
+        chat_model.rewind()
+        chat_history = get_user_inputs_from_chat_model(chat_model, user_msg).strip()
+        new_sys_prompt = get_steering_system_prompt(steering_branch, chat_history)
+        st.session_state["chat_model"] = get_llm_chat_instance(new_sys_prompt, chat_model)
+        chat_model = st.session_state["chat_model"]
+        response = chat_model.send_message(user_msg)
 
-        elif not conversation_labels.current_state or conversation_labels.current_state == "None":
-            new_sys_prompt = get_chatbot_system_prompt(
-                additional_info="- The current state (or real outcome) that this person experienced",
-                sahha_insights=get_sahha_insights(1, 1),
-                similar_issues=get_db_context(chat_history),
-            )
+    return response, conversation_labels.model_dump()
 
-            st.session_state["chat_model"] = get_llm_chat_instance(new_sys_prompt, chat_model)
-            chat_model = st.session_state["chat_model"]
 
-        elif not conversation_labels.desired_state or conversation_labels.desired_state == "None":
-            new_sys_prompt = get_chatbot_system_prompt(
-                additional_info="- The desired state (or desired outcome, expectation) that this person expected.",
-                sahha_insights=get_sahha_insights(1, 1),
-                similar_issues=get_db_context(chat_history),
-            )
+def stream_chat_with_user(user_msg, full_extraction=False):
+    """
+    Streaming version of chat_with_user, yields the reply in chunks as they arrive.
+
+    Conversation labels are extracted in the background while the reply streams. Once the stream
+    ends, the labels are stored in the session and any change of steering branch is applied to
+    the system prompt for the next turn. The time to first token of every turn is recorded in
+    st.session_state["turn_metrics"].
+    """
+    turn_start = time.perf_counter()
+    time_to_first_token = None
 
+    chat_model = st.session_state["chat_model"]
+
+    labels_future = None
+    if has_previous_user_msgs(chat_model):
+        labels_future = submit_label_extraction(chat_model, user_msg, full_extraction)
+
+    for chunk in chat_model.send_message(user_msg, stream=True):
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - turn_start
+        yield chunk
+
+    conversation_labels = DeepDiveConversationLabels()
+    if labels_future is not None:
+        conversation_labels = labels_future.result()
+        st.session_state["label_state"] = conversation_labels
+        steering_branch = get_steering_branch(conversation_labels)
+        previous_steering_branch = st.session_state.get("steering_branch") or "emotions"
+        st.session_state["steering_branch"] = steering_branch
+
+        if steering_branch == "complete":
+            output_dict = finalize_diary_entry(chat_model, conversation_labels)
+            st.session_state["conversation_labels"] = output_dict
+            yield f"\n\n{COMPLETION_MESSAGE}"
+        elif steering_branch != previous_steering_branch:
+            chat_history = get_user_inputs_from_chat_model(chat_model).strip()
+            new_sys_prompt = get_steering_system_prompt(steering_branch, chat_history)
             st.session_state["chat_model"] = get_llm_chat_instance(new_sys_prompt, chat_model)
-            chat_model = st.session_state["chat_model"]
-
-        else:
-            # add to vectorstore
-            diary_entry_summary = summarize_new_entry(chat_model)
-            output_dict = prepare_output_dict(conversation_labels, diary_entry_summary)
-            st.session_state["output_complete_flag"] = "True"
-            generate_analytics_new_entry(output_dict)
-            return (
-                "Thanks for sharing! You've finished your reflection and submitted a new diary entry.",
-                output_dict,
-            )
 
-    response = chat_model.send_message(user_msg)
+    if st.session_state.get("steering_branch") != "complete":
+        st.session_state["conversation_labels"] = conversation_labels.model_dump()
+
+    st.session_state.setdefault("turn_metrics", []).append(
+        {
+            "time_to_first_token": time_to_first_token,
+            "total_time": time.perf_counter() - turn_start,
+        }
+    )
+
+
+def has_previous_user_msgs(chat_model):
+    return len(chat_model.messages("user")) > 0
+
+
+def submit_label_extraction(chat_model, user_msg, full_extraction=False):
+    """
+    Starts the conversation label extraction in the background. The running labels in
+    st.session_state["label_state"] are updated with only the new user message, the whole
+    conversation is re-extracted when there is no running state yet or full_extraction is set.
+    """
+    label_state = st.session_state.get("label_state")
+    if full_extraction or label_state is None:
+        chat_history = get_user_inputs_from_chat_model(chat_model, user_msg).strip()
+        return _background_executor.submit(extract_info_from_conversation, chat_history)
 
-    return response.text, conversation_labels.model_dump()
+    return _background_executor.submit(update_info_from_conversation, label_state, user_msg)
 
 
 def get_user_inputs_from_chat_model(chat_model, user_msg=""):
-    chat_history = ""
-    for msg in chat_model.history[2:]:
-        if msg.role == "user":
-            chat_history += msg.parts[0].text + "\n\n"
+    chat_history = f"{chat_model.summary}\n\n" if chat_model.summary else ""
+    for _, text in chat_model.messages("user"):
+        chat_history += text + "\n\n"
 
     chat_history += f"{user_msg} \n\n"
 
@@ -0,0 +1,36 @@
+import os
+import shutil
+
+import pytest
+
+# tests run offline, every vector is embedded with the local hashing encoder
+os.environ["EMBEDDING_BACKEND"] = "hashing"
+
+import utils.embeddings as embeddings  # noqa: E402
+import utils.journal_query as jq  # noqa: E402
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+SHIPPED_INDEX_PATH = os.path.join(REPO_PATH, "faiss_index")
+
+
+@pytest.fixture(autouse=True)
+def offline(tmp_path, monkeypatch):
+    """
+    Runs each test in its own directory with a fresh hashing embeddings client and no loaded
+    vector stores, so relative data paths and process-wide caches do not leak between tests
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(embeddings, "_embeddings", embeddings.create_embeddings("hashing"))
+    jq._db_cache.clear()
+    yield
+    jq._db_cache.clear()
+
+
+@pytest.fixture
+def shipped_index(tmp_path):
+    """
+    Copy of the repository's single, unsharded faiss_index
+    """
+    index_path = str(tmp_path / "faiss_index")
+    shutil.copytree(SHIPPED_INDEX_PATH, index_path)
+    return index_path
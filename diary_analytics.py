@@ -1,32 +1,60 @@
+import argparse
+import json
 import os
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
 
 import google.generativeai as genai
-import pandas as pd
 from dotenv import load_dotenv
 from langchain.chains import LLMChain
-from langchain_community.vectorstores import FAISS
+from langchain.output_parsers import PydanticOutputParser
 from langchain_core.documents import Document
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel, Field
 
+import utils.journal_shards as journal_shards
+import utils.journal_store as js
 from old_diary_entries import emotions, key_topics, mental_tendencies
+from utils.analytics_cache import schedule_render
+from utils.llm_utils import RateLimiter, get_completion, get_llm_instance
 from utils.prompt_templates import (
     generate_emotions_template,
     generate_key_topics_template,
     generate_mental_tendencies_template,
     generate_reflection_questions_template,
 )
+from utils.sentiment import score_sentiment
+from utils.user_partitions import DEFAULT_USER_ID, get_user_partition
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+# upper bound on concurrent llm calls made while tagging a single entry
+TAGGING_MAX_WORKERS = int(os.getenv("TAGGING_MAX_WORKERS", "4"))
+
+# number of entries packed into a single request when backfilling tags
+BACKFILL_BATCH_SIZE = 5
+BACKFILL_REQUESTS_PER_MINUTE = 30
+
+_tagging_model = None
+
+
+def get_tagging_model():
+    """
+    Shared chat model for the taggers, so concurrent calls reuse one client
+    """
+    global _tagging_model
+    if _tagging_model is None:
+        _tagging_model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    return _tagging_model
+
 
 def generate_reflection_questions(diary_entry):
     """
     Uses gemini to generate reflection questions to diary entries
     """
     entry_content = diary_entry["entry_content"]
-    model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    model = get_tagging_model()
     prompt_template = generate_reflection_questions_template()
     prompt_template.format(entry_content=entry_content)
     chain = LLMChain(llm=model, prompt=prompt_template)
@@ -41,7 +69,7 @@ def generate_mental_tendencies(diary_entry):
     Uses gemini to tag mental tendencies to diary entries
     """
     entry_content = diary_entry["entry_content"]
-    model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    model = get_tagging_model()
     prompt_template = generate_mental_tendencies_template()
     prompt_template.format(entry_content=entry_content, mental_tendencies=mental_tendencies)
     chain = LLMChain(llm=model, prompt=prompt_template)
@@ -56,7 +84,7 @@ def generate_emotions(diary_entry):
     Uses gemini to tag emotions to diary entries
     """
     entry_content = diary_entry["entry_content"]
-    model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    model = get_tagging_model()
     prompt_template = generate_emotions_template()
     prompt_template.format(entry_content=entry_content, emotions=emotions)
     chain = LLMChain(llm=model, prompt=prompt_template)
@@ -71,7 +99,7 @@ def generate_key_topics(diary_entry):
     Uses gemini to generate key topics to diary entries
     """
     entry_content = diary_entry["entry_content"]
-    model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    model = get_tagging_model()
     prompt_template = generate_key_topics_template()
     prompt_template.format(entry_content=entry_content, key_topics=key_topics)
     chain = LLMChain(llm=model, prompt=prompt_template)
@@ -81,47 +109,231 @@ def generate_key_topics(diary_entry):
     return response
 
 
+TAGGERS = {
+    "emotions": generate_emotions,
+    "key_topics": generate_key_topics,
+    "mental_tendencies": generate_mental_tendencies,
+    "reflection_questions": generate_reflection_questions,
+}
+
+
+def tag_diary_entry(diary_entry: Dict, max_workers: int = TAGGING_MAX_WORKERS) -> Dict:
+    """
+    Runs every tagger on the diary entry concurrently, so tagging takes about as long as the
+    slowest single call. A tagger that fails leaves its field empty instead of failing the entry.
+    """
+    tags = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(tagger, diary_entry): field for field, tagger in TAGGERS.items()
+        }
+        for future in as_completed(futures):
+            field = futures[future]
+            try:
+                tags[field] = future.result()
+            except Exception as e:
+                print(f"failed to generate {field}: {str(e)}")
+                tags[field] = ""
+
+    return tags
+
+
 def generate_analytics_old_entries(diary_entry: Dict):
-    emotions = generate_emotions(diary_entry)
-    key_topics = generate_key_topics(diary_entry)
-    mental_tendencies = generate_mental_tendencies(diary_entry)
-    reflection_questions = generate_reflection_questions(diary_entry)
+    tags = tag_diary_entry(diary_entry)
+
+    return (
+        tags["emotions"],
+        tags["key_topics"],
+        tags["mental_tendencies"],
+        tags["reflection_questions"],
+    )
 
-    return emotions, key_topics, mental_tendencies, reflection_questions
 
+class DiaryEntryTags(BaseModel):
+    entry: str = Field(description="The entry id exactly as given.")
+    emotions: List[str] = Field(description="The emotions from the emotions list that apply.")
+    key_topics: List[str] = Field(description="The key topics from the key topics list that apply.")
+    mental_tendencies: List[str] = Field(
+        description="The mental tendencies from the mental tendencies list that apply."
+    )
+    reflection_questions: List[str] = Field(
+        description="3 questions to reflect upon to improve this situation."
+    )
 
-def add_new_diary_to_db_and_csv(diary_entry: Dict):
+
+class BatchDiaryEntryTags(BaseModel):
+    entries: List[DiaryEntryTags] = Field(description="The tags for every diary entry given.")
+
+
+def tag_diary_entries_batch(diary_entries: List[Dict]) -> Dict[str, Dict]:
     """
-    Add new diary entries to the vector store and csv file
+    Tags several diary entries with a single structured llm request.
+    Returns the tags keyed by entry id, entries the model skipped are left out.
     """
-    csv_data = pd.read_csv("data/journal_entries_v4.csv")
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector_store = FAISS.load_local(
-        "faiss_index", embeddings=embeddings, allow_dangerous_deserialization=True
+    parser = PydanticOutputParser(pydantic_object=BatchDiaryEntryTags)
+    entries_str = "\n\n".join(
+        f"Entry id: {diary_entry['entry']}\n```\n{diary_entry['entry_content']}\n```"
+        for diary_entry in diary_entries
     )
+
+    prompt = f"""
+Tag each of the following diary entries. Only use labels from these lists.
+Emotions: {emotions}
+Key topics: {key_topics}
+Mental tendencies: {mental_tendencies}
+{parser.get_format_instructions()}
+{entries_str}
+    """.strip()
+
+    output = get_completion(get_llm_instance(), prompt)
+    parsed_output = parser.parse(output)
+
+    entry_ids = {str(diary_entry["entry"]) for diary_entry in diary_entries}
+    tags = {}
+    for entry_tags in parsed_output.entries:
+        if entry_tags.entry not in entry_ids:
+            continue
+        tags[entry_tags.entry] = {
+            "emotions": str([label for label in entry_tags.emotions if label in emotions]),
+            "key_topics": str([label for label in entry_tags.key_topics if label in key_topics]),
+            "mental_tendencies": str(
+                [label for label in entry_tags.mental_tendencies if label in mental_tendencies]
+            ),
+            "reflection_questions": "\n".join(
+                f"{i + 1}. {question}" for i, question in enumerate(entry_tags.reflection_questions)
+            ),
+        }
+    return tags
+
+
+def _load_backfill_checkpoint(checkpoint_path: str) -> Dict[str, Dict]:
+    tags = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    tags.update(json.loads(line))
+    return tags
+
+
+def backfill_analytics(
+    batch_size: int = BACKFILL_BATCH_SIZE,
+    max_workers: int = TAGGING_MAX_WORKERS,
+    requests_per_minute: float = BACKFILL_REQUESTS_PER_MINUTE,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
+    resume: bool = True,
+    partition=None,
+) -> Dict:
+    """
+    Re-tags historical entries, e.g. after the emotions, key_topics or mental_tendencies lists
+    change.
+
+    Entries are packed batch_size at a time into one structured request and batches run in
+    parallel under a rate limit. Every finished batch is appended to a checkpoint file so an
+    interrupted run picks up where it stopped when called again. Once every entry is tagged,
+    the journal store and the vector store metadata are each updated in one bulk write.
+    partition is the UserPartition to re-tag, the default user when not given.
+    """
+    partition = partition or get_user_partition()
+    checkpoint_path = checkpoint_path or partition.backfill_checkpoint_path
+    if not resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    diary_entries = js.read_entries(
+        columns=["entry", "entry_content"],
+        start_date=start_date,
+        end_date=end_date,
+        db_path=partition.journal_db_path,
+    ).to_dict("records")
+    tags = _load_backfill_checkpoint(checkpoint_path)
+    pending = [diary_entry for diary_entry in diary_entries if diary_entry["entry"] not in tags]
+    batches = [pending[i : i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    rate_limiter = RateLimiter(requests_per_minute)
+
+    def run_batch(batch):
+        rate_limiter.wait()
+        return tag_diary_entries_batch(batch)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            try:
+                batch_tags = future.result()
+            except Exception as e:
+                print(f"failed to tag batch: {str(e)}")
+                continue
+            with open(checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(batch_tags) + "\n")
+            tags.update(batch_tags)
+            print(f"tagged {len(tags)}/{len(diary_entries)} entries")
+
+    remaining = [d["entry"] for d in diary_entries if d["entry"] not in tags]
+    if remaining:
+        return {
+            "status": "incomplete",
+            "message": f"{len(remaining)} entries are not tagged yet, run again to resume.",
+        }
+
+    entry_ids = {diary_entry["entry"] for diary_entry in diary_entries}
+    updated_entries = [
+        {**row, **tags[row["entry"]]}
+        for row in js.read_entries(
+            start_date=start_date, end_date=end_date, db_path=partition.journal_db_path
+        ).to_dict("records")
+        if row["entry"] in entry_ids
+    ]
+    js.update_entries(updated_entries, db_path=partition.journal_db_path)
+    journal_shards.update_documents_metadata(
+        {entry_id: tags[entry_id] for entry_id in entry_ids}, partition.index_path
+    )
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return {"status": "success", "message": f"Re-tagged {len(updated_entries)} entries."}
+
+
+def add_new_diary_to_db_and_csv(diary_entry: Dict, partition=None):
+    """
+    Add new diary entries to the vector store and journal store of the partition's user
+    """
+    partition = partition or get_user_partition()
     diary_entry_copy = diary_entry.copy()
 
     document = Document(
         page_content=diary_entry_copy.pop("entry_content"), metadata=diary_entry_copy
     )
-    vector_store.add_documents([document])
-    vector_store.save_local("faiss_index")
+    journal_shards.add_documents([document], index_path=partition.index_path)
     print("added to vectorstore")
 
-    new_row_in_csv = len(csv_data)
-    csv_data.loc[new_row_in_csv] = diary_entry
-    csv_data.to_csv("data/journal_entries_v4.csv", index=False)
-    print("added to csv")
+    js.add_entry(diary_entry, db_path=partition.journal_db_path)
+    print("added to journal store")
+
+
+def generate_analytics_new_entry(output_dict: Dict, partition=None):
+    partition = partition or get_user_partition()
+    output_dict.update(tag_diary_entry(output_dict))
+    output_dict["sentiment"] = score_sentiment(output_dict.get("entry_content"))
 
+    add_new_diary_to_db_and_csv(output_dict, partition)
+    schedule_render(partition.journal_db_path, partition.analytics_cache_path)
 
-def generate_analytics_new_entry(output_dict: Dict):
-    emotions = generate_emotions(output_dict)
-    key_topics = generate_key_topics(output_dict)
-    mental_tendencies = generate_mental_tendencies(output_dict)
-    reflection_questions = generate_reflection_questions(output_dict)
-    output_dict["emotions"] = emotions
-    output_dict["key_topics"] = key_topics
-    output_dict["mental_tendencies"] = mental_tendencies
-    output_dict["reflection_questions"] = reflection_questions
 
-    add_new_diary_to_db_and_csv(output_dict)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-tag historical journal entries")
+    parser.add_argument("user_ids", nargs="*", default=[DEFAULT_USER_ID])
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    parser.add_argument("--restart", action="store_true", help="ignore an earlier checkpoint")
+    args = parser.parse_args()
+    for user_id in args.user_ids:
+        print(
+            backfill_analytics(
+                start_date=args.start_date,
+                end_date=args.end_date,
+                resume=not args.restart,
+                partition=get_user_partition(user_id),
+            )
+        )
@@ -1,6 +1,8 @@
 import streamlit as st
 from dotenv import load_dotenv
 
+import utils.journal_query as jq
+from utils.embeddings import get_embeddings
 from utils.llm_utils import *
 from utils.streamlit_utils import *
 
@@ -31,7 +33,19 @@ with st.expander("Debug view"):
         st.write(st.session_state["conversation_labels"])
 
     if st.session_state["chat_model"]:
-        st.write(st.session_state["chat_model"].history[0].parts[0].text)
+        st.write(st.session_state["chat_model"].system_prompt)
+        st.write(
+            {
+                "system_prompt_sections": st.session_state["prompt_token_usage"],
+                "next_message": st.session_state["chat_model"].token_usage(),
+            }
+        )
+
+    st.write({"embedding_cache": get_embeddings().stats()})
+    st.write({"user": current_user_partition().user_id, "vector_store_cache": jq.cache_stats()})
+
+    if st.session_state.get("turn_metrics"):
+        st.write({"turn_metrics": st.session_state["turn_metrics"]})
 
 if st.session_state["explore_further_enabled"]:
     chat_history_box = st.container()
@@ -43,13 +57,10 @@ if st.session_state["explore_further_enabled"]:
     prompt = st.chat_input()
     if prompt:
         st.chat_message("user").write(prompt)
+        st.session_state.messages.append({"role": "user", "content": prompt})
 
-        response, conversation_labels = chat_with_user(prompt)
-
-        st.session_state["conversation_labels"] = conversation_labels
+        # labels and the session history are updated once the stream ends
+        response = st.chat_message("assistant").write_stream(stream_chat_with_user(prompt))
 
-        st.session_state.messages.append({"role": "user", "content": prompt})
         st.session_state.messages.append({"role": "assistant", "content": response})
-
-        st.chat_message("assistant").write(response)
         st.rerun()
@@ -40,6 +40,35 @@ The following are thoughts from a user, extract the following information.
     return parsed_output
 
 
+def update_info_from_conversation(conversation_labels, user_msg):
+    """
+    Updates the running conversation labels with a single new user message, so the prompt does not
+    grow with the length of the conversation
+    """
+    parser = PydanticOutputParser(pydantic_object=DeepDiveConversationLabels)
+
+    prompt = f"""
+The following are labels extracted so far from a user's thoughts, followed by a new message from the user.
+Update the labels with any new information in the new message and keep the existing labels otherwise.
+{parser.get_format_instructions()}
+Current labels:
+```
+{conversation_labels.model_dump_json()}
+```
+New message:
+```
+{user_msg}
+```
+    """.strip()
+
+    model = get_llm_instance()
+
+    output = get_completion(model, prompt)
+    parsed_output = parser.parse(output)
+
+    return parsed_output
+
+
 class DiaryEntrySummary(BaseModel):
     entry_title: str = Field(
         description="Summarize this person's desired state with a goal of understanding this person's value. Turn this person's value into the title. Write this in first person perspective."
@@ -50,10 +79,10 @@ class DiaryEntrySummary(BaseModel):
 
 
 def summarize_new_entry(chat_model):
-    chat_history = ""
+    chat_history = f"summary: {chat_model.summary} \n\n" if chat_model.summary else ""
 
-    for msg in chat_model.history[2:]:
-        chat_history += f"{msg.role}: {msg.parts[0].text} \n\n"
+    for role, text in chat_model.messages():
+        chat_history += f"{role}: {text} \n\n"
 
     parser = PydanticOutputParser(pydantic_object=DiaryEntrySummary)
 
@@ -1,7 +1,3 @@
-import pandas as pd
-
-old_diary_entries = pd.read_csv("data/journal_entries_v4.csv")
-
 mental_tendencies = [
     "High Expectations",
     "External Validation",
@@ -9,11 +9,8 @@ from dotenv import load_dotenv
 
 #from agent_chain import generate_initial_prompts
 #from agent_chain import summary_prompts
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from utils.llm_utils import get_sahha_insights
+from utils.insights_cache import get_actionable_insights, refresh_actionable_insights
+from utils.user_partitions import current_user_partition
 
 #result_topic, result_insights = summary_prompts()
 
@@ -32,30 +29,13 @@ st.header("Full Table Synthesis We have taken a deeper dive at your entries and
 
 st.subheader("Actionable Insights")
 
-model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
-embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-vector_store = FAISS.load_local(
-    "faiss_index", embeddings=embeddings, allow_dangerous_deserialization=True
-)
-# context is part of the vector store
-past_entries = vector_store.search(" ", search_type="similarity", k=4)
-context = "\n".join(entry.page_content for entry in past_entries)
-
-
-sahha_prompt, well_being_score = get_sahha_insights(1,1)
-
-prompt_template = f"""
-I want to extract 5 actionable insights from the following data. Each point should be less than 20 words.
-These are some of my past journal entries: {context}.
-And this is some data of my daily activities: {sahha_prompt}
-"""
-image_placeholder = st.empty()
-
-with st.spinner('Loading from RAG...'):
-    prompt = PromptTemplate(template=prompt_template, input_variables=["context", "sahha_prompt"])
-    prompt.format(context=context, sahha_prompt=sahha_prompt)
-    chain = LLMChain(llm=model, prompt=prompt)
-    inputs = {"context": context, "sahha_prompt": sahha_prompt}
-    result_insights = chain.run(inputs)
+partition = current_user_partition()
+result_insights, is_fresh = get_actionable_insights(partition)
+if result_insights is None:
+    # first visit, nothing cached yet
+    with st.spinner('Loading from RAG...'):
+        result_insights = refresh_actionable_insights(partition)
+elif not is_fresh:
+    st.caption("Your data changed since these insights were generated, an update is on its way.")
 
-st.write(result_insights)
\ No newline at end of file
+st.write(result_insights)
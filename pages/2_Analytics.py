@@ -1,38 +1,47 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from wordcloud import WordCloud
-import plotly.express as px
-import plotly.graph_objects as go
-from textblob import TextBlob
+import utils.journal_store as js
+from utils.analytics_cache import get_rendered_analytics
 from utils.llm_utils import get_sahha_insights
+from utils.sahha_store import get_sahha_store
+from utils.sahha_trends import get_factor_trends
+from utils.user_partitions import current_user_partition
 
 
-sahha_prompt, well_being_score = get_sahha_insights(1,1)
+NO_DATA = "Not enough tagged journal entries yet."
 
-# Load the data
-file_path = 'data/journal_entries_v4.csv'
-data = pd.read_csv(file_path)
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("'", ""))
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("[", ""))
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("]", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("'", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("[", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("]", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("'", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("[", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("]", ""))
 
-# Convert entry_date to datetime
-data['entry_date'] = pd.to_datetime(data['entry_date'], format='%Y-%m-%d')
+def show_figure(figure):
+    # figures are None until the journal has data for them
+    if figure is None:
+        st.write(NO_DATA)
+    else:
+        st.plotly_chart(figure)
+
+
+partition = current_user_partition()
+sahha_prompt, well_being_score = get_sahha_insights(1, partition.sahha_user_id)
 
 # Page title
 st.title("Journal Entries Analytics")
 
+if not js.get_entry_stats(partition.journal_db_path)['num_entries']:
+    st.write("No journal entries yet.")
+    st.stop()
+
+if js.has_unscored_entries(db_path=partition.journal_db_path):
+    # entries stored before sentiment was scored at ingest time are left out of the sentiment chart
+    st.info(
+        "Some older journal entries have no sentiment score yet, "
+        f"run `python -m utils.sentiment {partition.user_id}` to score them."
+    )
+
+# Figures are rendered once per journal data version and loaded from disk afterwards
+rendered = get_rendered_analytics(partition.journal_db_path, partition.analytics_cache_path)
+figures, wordclouds = rendered['figures'], rendered['wordclouds']
+
 # Display number of journal entries and latest journal entry date
-num_entries = len(data)
-latest_entry_date = data['entry_date'].max().strftime('%Y-%m-%d')
+num_entries = rendered['stats']['num_entries']
+latest_entry_date = rendered['stats']['latest_entry_date']
 col1, col2, col3 = st.columns(3)
 col1.metric("Well Being Score (Powered by Sahha)", well_being_score)
 col2.metric("Number of Journal Entries", num_entries)
@@ -40,43 +49,42 @@ col3.metric("Latest Journal Entry Date", latest_entry_date)
 
 # Most common emotions
 st.header("Most Common Emotions")
-emotions = data['emotions'].str.split(', ').explode()
-emotions_count = emotions.value_counts()
-fig_emotions_count = px.bar(emotions_count, labels={'index': 'Emotions', 'value': 'Count'})
-st.plotly_chart(fig_emotions_count)
+show_figure(figures['emotions_count'])
+
+# Emotions that appear in the same entries
+st.header("Emotions Felt Together")
+show_figure(figures['emotions_cooccurrence'])
 
 # Word cloud of key topics
 st.header("Word Cloud of Key Topics")
-key_topics = ' '.join(data['key_topics'].dropna().tolist())
-wordcloud = WordCloud(width=800, height=400, background_color='white').generate(key_topics)
-st.image(wordcloud.to_array(), use_column_width=True)
+if wordclouds['key_topics']:
+    st.image(wordclouds['key_topics'], use_column_width=True)
+else:
+    st.write(NO_DATA)
 
 # Word cloud of mental tendencies
 st.header("Word Cloud of Mental Tendencies")
-mental_tendencies = ' '.join(data['mental_tendencies'].dropna().tolist())
-wordcloud = WordCloud(width=800, height=400, background_color='white').generate(mental_tendencies)
-st.image(wordcloud.to_array(), use_column_width=True)
+if wordclouds['mental_tendencies']:
+    st.image(wordclouds['mental_tendencies'], use_column_width=True)
+else:
+    st.write(NO_DATA)
 
 # Heatmap of emotions over time
 st.header("Heatmap of Emotions Over Time")
-emotions_over_time = data[['entry_date', 'emotions']].copy()
-emotions_over_time = emotions_over_time.set_index('entry_date').emotions.str.get_dummies(sep=', ').resample('M').sum()
-emotions_over_time = emotions_over_time.reset_index().melt(id_vars='entry_date', var_name='emotions', value_name='Count')
-fig_heatmap = px.density_heatmap(emotions_over_time, x='entry_date', y='emotions', z='Count',
-                                 color_continuous_scale='Viridis', labels={'entry_date': 'Date', 'Count': 'Count'})
-st.plotly_chart(fig_heatmap)
+show_figure(figures['heatmap'])
 
 # Bubble chart of key topics
 st.header("Bubble Chart of Key Topics")
-key_topics_list = data['key_topics'].str.split(', ').explode().value_counts().reset_index()
-key_topics_list.columns = ['Key Topic', 'Frequency']
-fig_bubble = px.scatter(key_topics_list, x='Key Topic', y='Frequency', size='Frequency', hover_name='Key Topic',
-                        size_max=60, labels={'Key Topic': 'Key Topics', 'Frequency': 'Frequency'})
-st.plotly_chart(fig_bubble)
+show_figure(figures['bubble'])
 
 # Sentiment analysis over time
 st.header("Sentiment Analysis Over Time")
-data['sentiment'] = data['entry_content'].apply(lambda x: TextBlob(x).sentiment.polarity)
-sentiment_over_time = data[['entry_date', 'sentiment']].set_index('entry_date').resample('M').mean().reset_index()
-fig_sentiment = px.line(sentiment_over_time, x='entry_date', y='sentiment', labels={'entry_date': 'Date', 'sentiment': 'Average Sentiment'})
-st.plotly_chart(fig_sentiment)
\ No newline at end of file
+show_figure(figures['sentiment'])
+
+# Sahha factor trends
+st.header("Sleep and Activity Trends (Powered by Sahha)")
+factor_trends = get_factor_trends()
+if partition.sahha_user_id is not None and not factor_trends.empty:
+    profile_id, _, _ = get_sahha_store().resolve(partition.sahha_user_id)
+    factor_trends = factor_trends[factor_trends['profile_id'] == profile_id]
+    st.dataframe(factor_trends.drop(columns=['profile_id']).set_index('factor'))
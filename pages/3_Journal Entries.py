@@ -1,47 +1,80 @@
+import math
+
 import streamlit as st
-import pandas as pd
+
+import utils.journal_store as js
+from utils.user_partitions import current_user_partition
+
+PAGE_SIZE_OPTIONS = [25, 50, 100]
+# columns shown in the listing, entry bodies are only loaded for the selected entry
+LISTING_COLUMNS = ['entry', 'entry_date', 'entry_title', 'emotions', 'key_topics', 'mental_tendencies']
+
+
+def format_labels(value):
+    return ", ".join(js.parse_labels(value))
 
 
 st.title('Journal App')
 
-file_path = 'data/journal_entries_v4.csv'
-data = pd.read_csv(file_path)
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("'", ""))
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("[", ""))
-data['emotions'] = data['emotions'].apply(lambda x: x.replace("]", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("'", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("[", ""))
-data['mental_tendencies'] = data['mental_tendencies'].apply(lambda x: x.replace("]", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("'", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("[", ""))
-data['key_topics'] = data['key_topics'].apply(lambda x: x.replace("]", ""))
-data['entry_date'] = pd.to_datetime(data['entry_date'], format='%Y-%m-%d')
-data['entry_date2'] = data['entry_date'].astype(str)
+db_path = current_user_partition().journal_db_path
+entry_stats = js.get_entry_stats(db_path)
+if not entry_stats['num_entries']:
+    st.write("No journal entries yet.")
+    st.stop()
+
+# Date range and page size, the listing query only touches the entry_date index and one page
+col1, col2, col3 = st.columns(3)
+start_date = col1.date_input("From", value=None)
+end_date = col2.date_input("To", value=None)
+page_size = col3.selectbox("Entries per page", PAGE_SIZE_OPTIONS)
+
+num_entries = js.count_entries(start_date=start_date, end_date=end_date, db_path=db_path)
+num_pages = max(1, math.ceil(num_entries / page_size))
+page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1, step=1)
+
+listing = js.read_entries(
+    columns=LISTING_COLUMNS,
+    start_date=start_date,
+    end_date=end_date,
+    limit=page_size,
+    offset=(page - 1) * page_size,
+    descending=True,
+    db_path=db_path,
+)
+for column in js.LABEL_COLUMNS:
+    listing[column] = listing[column].apply(format_labels)
+listing = listing.fillna('')
+st.caption(f"{num_entries} entries")
+st.dataframe(listing.drop(columns=['entry']), hide_index=True)
 
-data = data.fillna('')
-st.dataframe(data)
+if listing.empty:
+    st.stop()
 
-selected_date = st.selectbox("Select an Entry Date", data['entry_date2'].unique())
+titles = {
+    row['entry']: f"{row['entry_date']} - {row['entry_title']}" if row['entry_title'] else row['entry_date']
+    for row in listing.to_dict('records')
+}
+selected_entry_id = st.selectbox("Select an Entry", list(titles), format_func=titles.get)
 
-# Filter data based on selected entry title
-selected_entry = data[data['entry_date2'] == selected_date].iloc[0]
+# Only the selected entry is loaded in full
+selected_entry = js.get_entry(selected_entry_id, db_path)
 
 # Display selected entry details
-st.header(f"Details for: {selected_date}")
+st.header(f"Details for: {selected_entry['entry_date']}")
 col1, col2 = st.columns(2)
 
 with col1:
     st.subheader("Entry Date")
     st.write(selected_entry['entry_date'])
     st.subheader("Entry Content")
-    st.write(selected_entry['entry_content'])
+    st.write(selected_entry['entry_content'] or '')
 
 with col2:
     st.subheader("Mental Tendencies")
-    st.write(selected_entry['mental_tendencies'])
+    st.write(format_labels(selected_entry['mental_tendencies']))
     st.subheader("Emotions")
-    st.write(selected_entry['emotions'])
+    st.write(format_labels(selected_entry['emotions']))
     st.subheader("Key Topics")
-    st.write(selected_entry['key_topics'])
+    st.write(format_labels(selected_entry['key_topics']))
     st.subheader("Reflection Questions")
-    st.write(selected_entry['reflection_questions'])
\ No newline at end of file
+    st.write(selected_entry['reflection_questions'] or '')
@@ -51,6 +51,7 @@ class SahhaUser(BaseModel):
         score (float): Overall wellbeing score calculated for the user.
         state (str): Qualitative assessment of the user's overall wellbeing state
         factors (List[SahhaScore]): List of SahhaScore objects representing individual factors contributing to the overall score.
+        scoreDateTime (Union[str, None]): Local date and time the scores were computed for.
     """
     id: str
     profileId: str
@@ -58,6 +59,7 @@ class SahhaUser(BaseModel):
     score: float  # wellbeing score
     state: str
     factors: List[SahhaScore]
+    scoreDateTime: Union[str, None] = None
 
     def to_dict(self):
         return {
@@ -0,0 +1,37 @@
+import utils.journal_store as js
+from utils.analytics_cache import get_rendered_analytics
+
+
+def _entry(entry_id, **labels):
+    return {"entry": entry_id, "entry_date": "2024-06-04", "entry_content": entry_id, **labels}
+
+
+def test_emotion_figures_count_the_label_masks(tmp_path):
+    db_path = str(tmp_path / "journal.db")
+    js.add_entry(_entry("a", emotions="['Fear', 'Hope']"), db_path)
+    js.add_entry(_entry("b", emotions="['Fear']"), db_path)
+
+    figures = get_rendered_analytics(db_path, str(tmp_path / "analytics_cache"))["figures"]
+
+    emotions_count = figures["emotions_count"].data[0]
+    assert list(emotions_count.x) == ["Fear", "Hope"]
+    assert list(emotions_count.y) == [2, 1]
+    cooccurrence = figures["emotions_cooccurrence"].data[0]
+    assert list(cooccurrence.x) == ["Fear", "Hope"]
+    assert [list(row) for row in cooccurrence.z] == [[2, 1], [1, 1]]
+
+
+def test_figures_without_data_are_left_out(tmp_path):
+    db_path = str(tmp_path / "journal.db")
+    # e.g. a first entry stored after the tagger failed
+    js.add_entry(_entry("a", emotions="['Fear']", key_topics=""), db_path)
+
+    rendered = get_rendered_analytics(db_path, str(tmp_path / "analytics_cache"))
+
+    assert rendered["figures"]["emotions_count"] is not None
+    assert rendered["figures"]["emotions_cooccurrence"] is not None
+    assert rendered["figures"]["heatmap"] is not None
+    assert rendered["figures"]["bubble"] is None
+    assert rendered["figures"]["sentiment"] is None
+    assert rendered["wordclouds"] == {"key_topics": None, "mental_tendencies": None}
+    assert rendered["stats"]["num_entries"] == 1
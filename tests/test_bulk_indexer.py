@@ -0,0 +1,48 @@
+import json
+import os
+
+import numpy as np
+
+import utils.journal_query as jq
+import utils.journal_shards as journal_shards
+import utils.journal_store as js
+from utils.bulk_indexer import CHECKPOINT_FILE_NAME, bulk_index_entries
+from utils.embeddings import get_embeddings
+from utils.user_partitions import get_user_partition
+
+
+def _indexed_vectors(index_path):
+    vectors = {}
+    for key in journal_shards.read_manifest(index_path)["shards"]:
+        db = jq.get_db(index_path=journal_shards.shard_path(key, index_path))
+        for position, docstore_id in db.index_to_docstore_id.items():
+            entry_id = db.docstore.search(docstore_id).metadata["entry"]
+            vectors[entry_id] = db.index.reconstruct(position)
+    return vectors
+
+
+def test_resume_re_embeds_entries_checkpointed_with_another_model():
+    partition = get_user_partition("alice")
+    for entry_id, text in [("a", "stressful week at work"), ("b", "long walk by the river")]:
+        js.add_entry(
+            {"entry": entry_id, "entry_date": "2024-06-04", "entry_content": text},
+            partition.journal_db_path,
+        )
+    # an interrupted run embedded "a" before the embedding backend changed
+    os.makedirs(partition.index_path)
+    stale = {
+        "entry": "a",
+        "text": "stressful week at work",
+        "metadata": {"entry": "a"},
+        "vector": jq.encode_vector(np.ones(768)),
+        "model": "models/text-embedding-004",
+    }
+    with open(os.path.join(partition.index_path, CHECKPOINT_FILE_NAME), "w") as f:
+        f.write(json.dumps([stale]) + "\n")
+
+    assert bulk_index_entries(partition)["status"] == "success"
+
+    vectors = _indexed_vectors(partition.index_path)
+    expected = get_embeddings().embed_documents(["stressful week at work"])[0]
+    assert sorted(vectors) == ["a", "b"]
+    assert np.allclose(vectors["a"], expected)
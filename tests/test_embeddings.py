@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+import utils.embeddings as embeddings
+import utils.journal_query as jq
+import utils.journal_shards as journal_shards
+from utils.embeddings import HashingEmbeddings, default_score_threshold, get_embeddings
+
+
+def _relevance(first, second):
+    # relevance the vector store derives from the squared L2 distance of unit vectors
+    distance = np.sum((np.asarray(first) - np.asarray(second)) ** 2)
+    return 1 - distance / np.sqrt(2)
+
+
+def test_hashing_embeddings_are_deterministic_unit_vectors():
+    encoder = HashingEmbeddings()
+    vectors = encoder.embed_documents(["I felt anxious before the review", ""])
+
+    assert len(vectors[0]) == encoder.dimensions
+    assert np.isclose(np.linalg.norm(vectors[0]), 1)
+    assert not np.any(vectors[1])
+    assert HashingEmbeddings().embed_query("I felt anxious before the review") == vectors[0]
+
+
+def test_hashing_threshold_separates_related_from_unrelated_text():
+    encoder = HashingEmbeddings()
+    entry = encoder.embed_query(
+        "Ran into an old colleague, we talked about work and how uncertain consulting feels"
+    )
+    threshold = default_score_threshold("hashing")
+
+    assert _relevance(encoder.embed_query("uncertain work in consulting"), entry) > threshold
+    assert _relevance(encoder.embed_query("baking sourdough bread"), entry) < threshold
+
+
+def test_google_threshold_separates_the_shipped_entries(shipped_index):
+    # the shipped index holds text-embedding-004 vectors of the repository's journal entries
+    db = jq.get_db(index_path=shipped_index)
+    vectors = {
+        db.docstore.search(docstore_id).page_content.split(".")[0]: db.index.reconstruct(position)
+        for position, docstore_id in db.index_to_docstore_id.items()
+    }
+    threshold = default_score_threshold("google")
+
+    assert _relevance(vectors["coding"], vectors["Coding"]) > threshold
+    assert _relevance(vectors["coding"], vectors["Frustrated"]) > threshold
+    assert _relevance(vectors["on Muy Thai"], vectors["coding"]) < threshold
+    assert _relevance(vectors["on Muy Thai"], vectors["Frustrated"]) < threshold
+
+
+def test_migrated_index_records_the_google_model(shipped_index):
+    manifest = journal_shards.read_manifest(shipped_index)
+
+    assert manifest["embedding_model"] == embeddings.EMBEDDING_MODEL
+    # the shipped vectors can not be searched or extended with the hashing encoder
+    with pytest.raises(ValueError, match="python -m utils.reembed"):
+        journal_shards.search_shards("work", 2, index_path=shipped_index)
+    with pytest.raises(ValueError, match="python -m utils.reembed"):
+        journal_shards.add_documents(
+            [Document(page_content="new entry", metadata={"date": "2024-07-01"})],
+            index_path=shipped_index,
+        )
+
+
+def test_reembedded_index_is_searchable(shipped_index):
+    from utils.reembed import reembed_index
+
+    assert reembed_index(shipped_index) == 9
+    manifest = journal_shards.read_manifest(shipped_index)
+    assert manifest["embedding_model"] == get_embeddings().model_name
+
+    docs, _ = journal_shards.search_shards(
+        "martial arts", 3, start_date="2024-01-01", index_path=shipped_index
+    )
+    assert docs
+    assert all(journal_shards.document_date(d.metadata) >= "2024-01-01" for d in docs)
+
+
+def test_index_with_unknown_model_is_refused(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    journal_shards.rebuild_shards(
+        [Document(page_content="an entry", metadata={"date": "2024-06-01"})],
+        index_path=index_path,
+    )
+    manifest = journal_shards.read_manifest(index_path)
+    manifest["embedding_model"] = None
+    journal_shards._write_manifest(manifest, index_path)
+
+    with pytest.raises(ValueError, match="unknown model"):
+        journal_shards.search_shards("entry", 1, index_path=index_path)
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import utils.journal_query as jq
+from utils.embeddings import get_embeddings
+from utils.hybrid_retriever import document_date, get_hybrid_index, merge_scored
+
+
+def _db(entries):
+    return FAISS.from_documents(
+        [Document(page_content=text, metadata=metadata) for text, metadata in entries],
+        get_embeddings(),
+    )
+
+
+def test_document_date_accepts_iso_and_legacy_dates():
+    assert document_date({"date": "Jun 4, 2024"}) == "2024-06-04"
+    assert document_date({"entry_date": "2024-06-04"}) == "2024-06-04"
+    assert document_date({"date": "2024-06-04 09:30:00"}) == "2024-06-04"
+    assert document_date({"date": "someday"}) is None
+    assert document_date({}) is None
+
+
+def test_date_filter_keeps_entries_with_legacy_dates():
+    db = _db(
+        [
+            ("sparring practice went well", {"date": "Jun 4, 2024"}),
+            ("started a new project at work", {"entry_date": "2024-06-20"}),
+            ("autumn walk", {"date": "Oct 15, 2023"}),
+        ]
+    )
+
+    docs, _ = jq.get_docs_with_query(
+        db, "practice", 5, score_threshold=-1, start_date="2024-06-01", end_date="2024-06-30"
+    )
+
+    assert sorted(d.page_content for d in docs) == [
+        "sparring practice went well",
+        "started a new project at work",
+    ]
+
+
+def test_label_filter_uses_the_fixed_vocabularies():
+    db = _db(
+        [
+            ("a tense meeting", {"date": "2024-06-01", "emotions": "['Fear', 'Anger']"}),
+            ("a calm evening", {"date": "2024-06-02", "emotions": "['Relief']"}),
+        ]
+    )
+
+    docs, _ = jq.get_docs_with_query(
+        db, "meeting", 5, score_threshold=-1, labels={"emotions": ["fear"]}
+    )
+
+    assert [d.page_content for d in docs] == ["a tense meeting"]
+
+
+# the vector store warns about hashing relevance below 0, see utils.embeddings.SCORE_THRESHOLDS
+@pytest.mark.filterwarnings("ignore:Relevance scores must be between 0 and 1")
+def test_dense_relevance_matches_the_vector_store():
+    db = _db([(text, {}) for text in ["work stress", "weekend hike", "family dinner"]])
+    query = "stressful work week"
+
+    index = get_hybrid_index(db, jq._db_lock)
+    index.refresh()
+    dense = index.dense(get_embeddings().embed_query(query), np.arange(3))
+
+    expected = {
+        document.page_content: score
+        for document, score in db.similarity_search_with_relevance_scores(query, k=3)
+    }
+    contents = [db.docstore.search(db.index_to_docstore_id[i]).page_content for i in range(3)]
+    assert np.allclose(dense, [expected[content] for content in contents], atol=1e-5)
+
+
+def test_lexical_weight_ranks_by_bm25():
+    db = _db(
+        [
+            ("nothing in common here", {}),
+            ("deadline deadline deadline at work", {}),
+            ("one deadline", {}),
+        ]
+    )
+
+    docs, scores = jq.get_docs_with_query(db, "deadline", 3, score_threshold=-1, lexical_weight=1)
+
+    assert [d.page_content for d in docs[:2]] == [
+        "deadline deadline deadline at work",
+        "one deadline",
+    ]
+    assert scores[0] == 1.0
+
+
+def test_lexical_scoring_holds_the_index_lock(monkeypatch):
+    db = _db([("deadline at work", {}), ("weekend hike", {})])
+    index = get_hybrid_index(db, jq._db_lock)
+    locked = []
+
+    def recording_lock(method):
+        def wrapper(*args):
+            locked.append(index._lock.locked())
+            return method(*args)
+
+        return wrapper
+
+    # refresh from another session grows the postings and doc_lengths under index._lock
+    for name in ["candidates", "bm25"]:
+        monkeypatch.setattr(index, name, recording_lock(getattr(index, name)))
+    index.score("deadline", 2, score_threshold=-1)
+
+    assert locked == [True, True]
+
+
+def test_merge_scored_scales_bm25_over_the_merged_set():
+    first, second = Document(page_content="first"), Document(page_content="second")
+
+    merged = merge_scored([(first, 0.5, 1.0), (second, 0.5, 4.0)], 2, lexical_weight=0.5)
+
+    assert [document.page_content for document, _ in merged] == ["second", "first"]
+    assert [round(score, 3) for _, score in merged] == [0.75, 0.375]
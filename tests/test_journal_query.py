@@ -0,0 +1,76 @@
+import os
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import utils.journal_query as jq
+from utils.embeddings import get_embeddings
+
+
+def _db_with(index_path, texts):
+    db = FAISS.from_documents(
+        [Document(page_content=text, metadata={"entry": text}) for text in texts], get_embeddings()
+    )
+    jq.save_db(db, index_path)
+    return db
+
+
+def _texts(db):
+    return sorted(document.page_content for document in db.docstore._dict.values())
+
+
+def test_add_documents_goes_through_the_write_ahead_log(tmp_path):
+    index_path = str(tmp_path / "index")
+    _db_with(index_path, ["first entry"])
+    base_version = jq.get_index_version(index_path)
+
+    jq.add_documents_to_db([Document(page_content="second entry")], index_path=index_path)
+
+    assert jq.get_index_version(index_path) == base_version
+    assert os.path.exists(os.path.join(index_path, jq.WAL_FILE_NAME))
+    assert _texts(jq.get_db(index_path=index_path)) == ["first entry", "second entry"]
+
+    # a new process loads the base index and replays the log
+    jq._db_cache.clear()
+    assert _texts(jq.get_db(index_path=index_path)) == ["first entry", "second entry"]
+
+
+def test_partially_written_log_record_is_replayed_once_complete(tmp_path):
+    index_path = str(tmp_path / "index")
+    _db_with(index_path, ["first entry"])
+    jq.add_documents_to_db([Document(page_content="second entry")], index_path=index_path)
+    wal_path = os.path.join(index_path, jq.WAL_FILE_NAME)
+    with open(wal_path) as f:
+        record = f.read()
+
+    jq._db_cache.clear()
+    with open(wal_path, "w") as f:
+        f.write(record[:-10])
+    assert _texts(jq.get_db(index_path=index_path)) == ["first entry"]
+
+    with open(wal_path, "w") as f:
+        f.write(record)
+    assert _texts(jq.get_db(index_path=index_path)) == ["first entry", "second entry"]
+
+
+def test_compaction_folds_the_log_into_the_base_index(tmp_path):
+    index_path = str(tmp_path / "index")
+    _db_with(index_path, ["first entry"])
+    jq.add_documents_to_db([Document(page_content="second entry")], index_path=index_path)
+
+    jq.compact_db(index_path)
+
+    assert not os.path.exists(os.path.join(index_path, jq.WAL_FILE_NAME))
+    jq._db_cache.clear()
+    assert _texts(jq.get_db(index_path=index_path)) == ["first entry", "second entry"]
+
+
+def test_least_recently_used_stores_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(jq, "MAX_LOADED_INDEX_BYTES", 1)
+    first_path, second_path = str(tmp_path / "first"), str(tmp_path / "second")
+    _db_with(first_path, ["first entry"])
+    _db_with(second_path, ["second entry"])
+
+    assert list(jq._db_cache) == [second_path]
+    assert jq.cache_stats()["evictions"] >= 1
+    assert _texts(jq.get_db(index_path=first_path)) == ["first entry"]
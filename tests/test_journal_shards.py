@@ -0,0 +1,132 @@
+import json
+import os
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import utils.journal_query as jq
+import utils.journal_shards as journal_shards
+from utils.embeddings import get_embeddings
+
+# months of the entries in the repository's faiss_index, stored with dates like "Jun 4, 2024"
+SHIPPED_MONTHS = ["2023-10", "2023-11", "2023-12", "2024-03", "2024-04", "2024-06"]
+
+
+def _document(text, date, **metadata):
+    return Document(page_content=text, metadata={"entry": text, "date": date, **metadata})
+
+
+def _shard_documents(index_path, key):
+    db = jq.get_db(index_path=journal_shards.shard_path(key, index_path))
+    return list(db.docstore._dict.values())
+
+
+def test_migrate_shipped_index_into_monthly_shards(shipped_index):
+    manifest = journal_shards.read_manifest(shipped_index)
+
+    assert sorted(manifest["shards"]) == SHIPPED_MONTHS
+    assert journal_shards.UNDATED_SHARD not in manifest["shards"]
+    assert sum(shard["count"] for shard in manifest["shards"].values()) == 9
+    assert manifest["shards"]["2024-06"] == {
+        "count": 1,
+        "first_date": "2024-06-04",
+        "last_date": "2024-06-04",
+    }
+    for key in manifest["shards"]:
+        for document in _shard_documents(shipped_index, key):
+            assert journal_shards.shard_key(document.metadata) == key
+
+
+def test_split_undated_shard_of_older_manifest(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    documents = [
+        _document("sparring went well", "Jun 4, 2024"),
+        _document("long walk by the river", "Oct 15, 2023"),
+        _document("no date on this one", ""),
+    ]
+    db = FAISS.from_documents(documents, get_embeddings())
+    jq.save_db(db, journal_shards.shard_path(journal_shards.UNDATED_SHARD, index_path))
+    with open(os.path.join(index_path, journal_shards.MANIFEST_FILE_NAME), "w") as f:
+        json.dump(
+            {
+                "granularity": "month",
+                "embedding_model": get_embeddings().model_name,
+                "shards": {"undated": {"count": 3, "first_date": None, "last_date": None}},
+            },
+            f,
+        )
+
+    manifest = journal_shards.read_manifest(index_path)
+
+    assert manifest["version"] == journal_shards.MANIFEST_VERSION
+    assert sorted(manifest["shards"]) == ["2023-10", "2024-06", "undated"]
+    assert [d.page_content for d in _shard_documents(index_path, "undated")] == [
+        "no date on this one"
+    ]
+    assert [d.page_content for d in _shard_documents(index_path, "2024-06")] == [
+        "sparring went well"
+    ]
+
+
+def test_search_shards_newest_first_within_dates(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    journal_shards.rebuild_shards(
+        [
+            _document("stressful week at work, deadlines everywhere", "2024-06-03"),
+            _document("work deadlines again, stressful review", "2024-05-20"),
+            _document("quiet sunday baking bread", "2024-05-12"),
+            _document("stressful work trip", "Mar 15, 2024"),
+        ],
+        index_path=index_path,
+    )
+
+    docs, scores = journal_shards.search_shards(
+        "stressful work deadlines", 2, score_threshold=-1, index_path=index_path
+    )
+    assert sorted(d.metadata["date"] for d in docs) == ["2024-05-20", "2024-06-03"]
+    assert list(scores) == sorted(scores, reverse=True)
+
+    docs, _ = journal_shards.search_shards(
+        "stressful work",
+        5,
+        score_threshold=-1,
+        start_date="2024-03-01",
+        end_date="2024-03-31",
+        index_path=index_path,
+    )
+    assert [d.metadata["date"] for d in docs] == ["Mar 15, 2024"]
+
+
+def test_search_shards_reaches_older_shards_past_unrelated_entries(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    journal_shards.rebuild_shards(
+        [
+            _document("went hiking with family in the mountains", "2024-06-10"),
+            _document("baked sourdough bread on sunday", "2024-06-02"),
+            _document("anxious about the work review and its deadlines", "2024-01-15"),
+        ],
+        index_path=index_path,
+    )
+
+    docs, _ = journal_shards.search_shards(
+        "anxious about work review deadlines", 2, index_path=index_path
+    )
+
+    assert [d.metadata["date"] for d in docs] == ["2024-01-15"]
+
+
+def test_add_documents_appends_to_the_shard_of_their_date(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    journal_shards.rebuild_shards([_document("first entry", "2024-06-01")], index_path=index_path)
+
+    journal_shards.add_documents(
+        [_document("second entry", "2024-06-02"), _document("older entry", "2024-01-05")],
+        index_path=index_path,
+    )
+
+    manifest = journal_shards.read_manifest(index_path)
+    assert {key: shard["count"] for key, shard in manifest["shards"].items()} == {
+        "2024-06": 2,
+        "2024-01": 1,
+    }
+    assert manifest["shards"]["2024-06"]["last_date"] == "2024-06-02"
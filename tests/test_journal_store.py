@@ -0,0 +1,110 @@
+import pytest
+
+import utils.journal_store as js
+from conftest import REPO_PATH
+
+# raw tagger output as the llm returns it, with a markdown heading
+TAGGER_OUTPUT = "**Mental tendencies:**\n- Perfectionism\n- Fear of Failure"
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "journal.db")
+
+
+def _entry(entry_id, entry_date, **fields):
+    return {"entry": entry_id, "entry_date": entry_date, "entry_content": entry_id, **fields}
+
+
+def test_parse_entry_date():
+    assert js.parse_entry_date("2024-06-04") == "2024-06-04"
+    assert js.parse_entry_date("Jun 4, 2024") == "2024-06-04"
+    assert js.parse_entry_date("June 4, 2024") == "2024-06-04"
+    assert js.parse_entry_date("not a date") is None
+    assert js.parse_entry_date(None) is None
+
+
+def test_label_aggregates_only_count_vocabulary_labels(db_path):
+    js.add_entry(
+        _entry("a", "2024-06-04", mental_tendencies=TAGGER_OUTPUT, emotions="['Fear']"), db_path
+    )
+    js.add_entry(_entry("b", "2024-07-01", emotions="Emotions:\n- fear\n- Hope"), db_path)
+
+    assert js.get_label_counts("mental_tendencies", db_path).to_dict("records") == [
+        {"label": "Fear of Failure", "count": 1},
+        {"label": "Perfectionism", "count": 1},
+    ]
+    assert js.get_label_counts("emotions", db_path).to_dict("records") == [
+        {"label": "Fear", "count": 2},
+        {"label": "Hope", "count": 1},
+    ]
+    assert js.get_monthly_label_counts("emotions", db_path).to_dict("records") == [
+        {"entry_month": "2024-06", "label": "Fear", "count": 1},
+        {"entry_month": "2024-07", "label": "Fear", "count": 1},
+        {"entry_month": "2024-07", "label": "Hope", "count": 1},
+    ]
+
+
+def test_update_entries_moves_the_aggregates(db_path):
+    js.add_entry(_entry("a", "2024-06-04", emotions="['Fear']"), db_path)
+
+    js.update_entries([_entry("a", "2024-06-04", emotions="['Hope']")], db_path)
+
+    assert js.get_label_counts("emotions", db_path).to_dict("records") == [
+        {"label": "Hope", "count": 1}
+    ]
+
+
+def test_label_table_rebuild_bumps_the_data_version(db_path):
+    js.add_entry(_entry("a", "2024-06-04", emotions="['Fear']"), db_path)
+    data_version = js.get_data_version(db_path)
+
+    # reopen the store as if it was written by schema version 3
+    js.get_connection(db_path).execute("PRAGMA user_version = 3")
+    js._initialized.discard(db_path)
+
+    assert js.get_data_version(db_path) == data_version + 1
+    assert js.get_label_counts("emotions", db_path)["label"].tolist() == ["Fear"]
+
+
+def test_read_entries_filters_and_pages(db_path):
+    for day in range(1, 6):
+        emotions = "['Fear']" if day % 2 else "['Hope']"
+        js.add_entry(_entry(f"e{day}", f"2024-06-0{day}", emotions=emotions), db_path)
+
+    page = js.read_entries(
+        columns=["entry"], limit=2, offset=1, descending=True, db_path=db_path
+    )
+    assert page["entry"].tolist() == ["e4", "e3"]
+
+    fear = js.read_entries(
+        columns=["entry"],
+        start_date="2024-06-02",
+        labels={"emotions": ["Fear"]},
+        db_path=db_path,
+    )
+    assert fear["entry"].tolist() == ["e3", "e5"]
+    assert js.count_entries(labels={"emotions": ["Hope"]}, db_path=db_path) == 2
+
+    with pytest.raises(ValueError):
+        js.read_entries(labels={"emotions": ["Not an emotion"]}, db_path=db_path)
+
+
+def test_unscored_entries(db_path):
+    js.add_entry(_entry("a", "2024-06-04", sentiment=0.5), db_path)
+    assert not js.has_unscored_entries(db_path)
+
+    js.add_entry(_entry("b", "2024-06-05"), db_path)
+    assert js.has_unscored_entries(db_path)
+
+    js.update_sentiments({"b": -0.2}, db_path)
+    assert not js.has_unscored_entries(db_path)
+
+
+def test_migrate_shipped_csv(db_path):
+    csv_path = f"{REPO_PATH}/data/journal_entries_v4.csv"
+
+    assert js.migrate_from_csv(csv_path, db_path) == 9
+    assert js.get_entry_stats(db_path)["num_entries"] == 9
+    assert not js.has_unscored_entries(db_path)
+    assert not js.get_label_counts("emotions", db_path).empty
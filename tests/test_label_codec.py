@@ -0,0 +1,28 @@
+import numpy as np
+
+from utils.label_codec import LabelCodec
+
+CODEC = LabelCodec(["Fear", "Hope", "Sadness"])
+
+
+def test_encode_and_decode():
+    mask = CODEC.encode(["hope", " Fear ", "Not a label"])
+
+    assert mask == 0b011
+    assert CODEC.decode(mask) == ["Fear", "Hope"]
+
+
+def test_count_and_cooccurrence():
+    masks = [CODEC.encode(["Fear", "Hope"]), CODEC.encode(["Fear"]), 0]
+
+    assert CODEC.count(masks).to_dict() == {"Fear": 2, "Hope": 1, "Sadness": 0}
+    cooccurrence = CODEC.cooccurrence(masks)
+    assert cooccurrence.loc["Fear", "Hope"] == cooccurrence.loc["Hope", "Fear"] == 1
+    assert np.diag(cooccurrence).tolist() == [2, 1, 0]
+
+
+def test_filter():
+    masks = [CODEC.encode(["Fear", "Hope"]), CODEC.encode(["Fear"]), CODEC.encode(["Sadness"])]
+
+    assert CODEC.filter(masks, ["Fear", "Hope"]).tolist() == [True, False, False]
+    assert CODEC.filter(masks, ["Hope", "Sadness"], match_all=False).tolist() == [True, False, True]
@@ -0,0 +1,44 @@
+from utils.llm_utils import ConversationSession
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StreamingModel:
+    def generate_content(self, history, stream=False):
+        return iter([_Chunk("Hello"), _Chunk(" there")])
+
+
+def _session():
+    session = ConversationSession("system prompt")
+    session._model = _StreamingModel
+    return session
+
+
+def _roles(session):
+    return [role for role, _ in session.messages()]
+
+
+def test_streamed_reply_is_added_with_its_user_turn():
+    session = _session()
+
+    assert "".join(session.send_message("hi", stream=True)) == "Hello there"
+    assert session.messages() == [("user", "hi"), ("model", "Hello there")]
+
+
+def test_stream_closed_early_keeps_turns_paired():
+    session = _session()
+
+    stream = session.send_message("first", stream=True)
+    next(stream)
+    stream.close()
+    assert session.messages() == [("user", "first"), ("model", "Hello")]
+
+    # closed before any chunk arrived, e.g. a rerun right after sending
+    session.send_message("second", stream=True).close()
+    assert _roles(session) == ["user", "model"]
+
+    "".join(session.send_message("third", stream=True))
+    assert _roles(session) == ["user", "model", "user", "model"]
@@ -0,0 +1,49 @@
+import json
+
+from utils.sahha_timeseries import SahhaTimeSeriesStore, to_day
+
+
+def _export(path, steps):
+    records = [
+        {
+            "profileId": "profile-1",
+            "scoreDateTime": f"2024-06-0{day}T00:00:00+00:00",
+            "type": "activity",
+            "score": 0.5,
+            "state": "medium",
+            "factors": [{"name": "steps", "value": value, "score": 0.5, "goal": 7500}],
+        }
+        for day, value in enumerate(steps, start=1)
+    ]
+    path.write_text(json.dumps(records))
+
+
+def _steps(store):
+    steps = store.load_factor("steps")
+    return dict(zip(steps["day"].tolist(), steps["value"].tolist()))
+
+
+def test_ingest_resumes_after_appended_records(tmp_path):
+    export = tmp_path / "scores.json"
+    store = SahhaTimeSeriesStore(str(tmp_path / "store"))
+    _export(export, [1000, 2000])
+    assert store.ingest(str(export)) == 2
+
+    _export(export, [1000, 2000, 3000])
+    assert store.ingest(str(export)) == 1
+    assert store.ingest(str(export)) == 0
+    assert _steps(store)[to_day("2024-06-03")] == 3000
+
+
+def test_ingest_restarts_a_rewritten_file_with_the_same_record_count(tmp_path):
+    export = tmp_path / "scores.json"
+    store = SahhaTimeSeriesStore(str(tmp_path / "store"))
+    _export(export, [1000, 2000])
+    store.ingest(str(export))
+
+    _export(export, [5000, 6000])
+    assert store.ingest(str(export)) == 2
+    assert _steps(store) == {to_day("2024-06-01"): 5000, to_day("2024-06-02"): 6000}
+
+    reopened = SahhaTimeSeriesStore(str(tmp_path / "store"))
+    assert reopened.ingest(str(export)) == 0
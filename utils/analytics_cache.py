@@ -0,0 +1,193 @@
+import json
+import os
+import shutil
+import threading
+from typing import Dict, Optional
+
+import pandas as pd
+import plotly.express as px
+import plotly.io as pio
+from wordcloud import WordCloud
+
+import utils.journal_store as js
+from utils.label_codec import LABEL_CODECS, mask_column
+
+ANALYTICS_CACHE_PATH = "data/analytics_cache"
+
+FIGURE_NAMES = ["emotions_count", "emotions_cooccurrence", "heatmap", "bubble", "sentiment"]
+WORDCLOUD_NAMES = ["key_topics", "mental_tendencies"]
+
+_render_lock = threading.Lock()
+_rendering = set()
+
+
+def _wordcloud(label_counts: pd.DataFrame) -> Optional[WordCloud]:
+    if label_counts.empty:
+        return None
+    return WordCloud(width=800, height=400, background_color="white").generate_from_frequencies(
+        dict(zip(label_counts["label"], label_counts["count"]))
+    )
+
+
+def _build_figures(db_path: str):
+    """
+    Plotly figures and word clouds of the analytics page, None for those without data yet, e.g.
+    when no entry has a vocabulary key topic
+    """
+    figures = dict.fromkeys(FIGURE_NAMES)
+
+    # emotion counts and co-occurrence are bit operations over the entries' label bitmasks
+    emotions_codec = LABEL_CODECS["emotions"]
+    emotions_masks = js.get_label_masks(db_path=db_path)[mask_column("emotions")]
+    emotions_count = emotions_codec.count(emotions_masks)
+    emotions_count = emotions_count[emotions_count > 0]
+    if not emotions_count.empty:
+        figures["emotions_count"] = px.bar(
+            x=emotions_count.index, y=emotions_count.values, labels={"x": "Emotions", "y": "Count"}
+        )
+        felt = emotions_count.index
+        figures["emotions_cooccurrence"] = px.imshow(
+            emotions_codec.cooccurrence(emotions_masks).loc[felt, felt],
+            color_continuous_scale="Viridis",
+            labels={"color": "Entries"},
+        )
+
+    emotions_over_time = js.get_monthly_label_counts("emotions", db_path=db_path)
+    if not emotions_over_time.empty:
+        emotions_over_time["entry_date"] = pd.to_datetime(
+            emotions_over_time["entry_month"], format="%Y-%m"
+        )
+        emotions_over_time = emotions_over_time.rename(
+            columns={"label": "emotions", "count": "Count"}
+        )
+        figures["heatmap"] = px.density_heatmap(
+            emotions_over_time,
+            x="entry_date",
+            y="emotions",
+            z="Count",
+            color_continuous_scale="Viridis",
+            labels={"entry_date": "Date", "Count": "Count"},
+        )
+
+    key_topics_count = js.get_label_counts("key_topics", db_path=db_path)
+    if not key_topics_count.empty:
+        key_topics_list = key_topics_count.rename(
+            columns={"label": "Key Topic", "count": "Frequency"}
+        )
+        figures["bubble"] = px.scatter(
+            key_topics_list,
+            x="Key Topic",
+            y="Frequency",
+            size="Frequency",
+            hover_name="Key Topic",
+            size_max=60,
+            labels={"Key Topic": "Key Topics", "Frequency": "Frequency"},
+        )
+
+    data = js.read_entries(columns=["entry_date", "sentiment"], db_path=db_path).dropna()
+    if not data.empty:
+        data["entry_date"] = pd.to_datetime(data["entry_date"], format="%Y-%m-%d")
+        sentiment_over_time = data.set_index("entry_date").resample("M").mean().reset_index()
+        figures["sentiment"] = px.line(
+            sentiment_over_time,
+            x="entry_date",
+            y="sentiment",
+            labels={"entry_date": "Date", "sentiment": "Average Sentiment"},
+        )
+
+    wordclouds = {
+        "key_topics": _wordcloud(key_topics_count),
+        "mental_tendencies": _wordcloud(js.get_label_counts("mental_tendencies", db_path=db_path)),
+    }
+    return figures, wordclouds
+
+
+def render_analytics(
+    db_path: str = js.JOURNAL_DB_PATH, cache_path: str = ANALYTICS_CACHE_PATH
+) -> int:
+    """
+    Renders the analytics page figures for the current journal data version into
+    cache_path/<version>/, plotly figures as json and word clouds as png, and removes the
+    renders of older versions. Returns the rendered version.
+    """
+    with _render_lock:
+        version = js.get_data_version(db_path)
+        version_path = os.path.join(cache_path, str(version))
+        if os.path.exists(version_path):
+            return version
+
+        figures, wordclouds = _build_figures(db_path)
+
+        tmp_path = f"{version_path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, figure in figures.items():
+            if figure is None:
+                continue
+            with open(os.path.join(tmp_path, f"{name}.json"), "w") as f:
+                f.write(pio.to_json(figure))
+        for name, wordcloud in wordclouds.items():
+            if wordcloud is not None:
+                wordcloud.to_file(os.path.join(tmp_path, f"{name}.png"))
+        with open(os.path.join(tmp_path, "stats.json"), "w") as f:
+            json.dump(js.get_entry_stats(db_path), f)
+        os.replace(tmp_path, version_path)
+
+        for name in os.listdir(cache_path):
+            if name != str(version):
+                shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
+        return version
+
+
+def _render_in_background(db_path: str, cache_path: str):
+    try:
+        render_analytics(db_path, cache_path)
+    except Exception as e:
+        print(f"failed to render analytics: {str(e)}")
+    finally:
+        _rendering.discard(cache_path)
+
+
+def schedule_render(db_path: str = js.JOURNAL_DB_PATH, cache_path: str = ANALYTICS_CACHE_PATH):
+    """
+    Re-renders the analytics figures in a background thread, e.g. after a new entry lands
+    """
+    if cache_path not in _rendering:
+        _rendering.add(cache_path)
+        threading.Thread(
+            target=_render_in_background, args=(db_path, cache_path), daemon=True
+        ).start()
+
+
+def get_rendered_analytics(
+    db_path: str = js.JOURNAL_DB_PATH, cache_path: str = ANALYTICS_CACHE_PATH
+) -> Dict:
+    '''
+    Loads the analytics page renders for the current journal data version, rendering them first
+    only if the cache does not have them yet.
+
+    Output
+    -----
+    figures: plotly figures by name (FIGURE_NAMES), None when there is nothing to show
+    wordclouds: png file path by name (WORDCLOUD_NAMES), None when there is nothing to show
+    stats: number of entries and latest entry date
+    '''
+    version = render_analytics(db_path, cache_path)
+    version_path = os.path.join(cache_path, str(version))
+
+    figures = {}
+    for name in FIGURE_NAMES:
+        json_path = os.path.join(version_path, f"{name}.json")
+        if not os.path.exists(json_path):
+            figures[name] = None
+            continue
+        with open(json_path) as f:
+            figures[name] = pio.from_json(f.read())
+    wordclouds = {}
+    for name in WORDCLOUD_NAMES:
+        png_path = os.path.join(version_path, f"{name}.png")
+        wordclouds[name] = png_path if os.path.exists(png_path) else None
+    with open(os.path.join(version_path, "stats.json")) as f:
+        stats = json.load(f)
+
+    return {"figures": figures, "wordclouds": wordclouds, "stats": stats}
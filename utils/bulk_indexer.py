@@ -0,0 +1,219 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+from langchain_core.documents import Document
+
+import utils.journal_query as jq
+import utils.journal_shards as journal_shards
+import utils.journal_store as js
+from utils.embeddings import get_embeddings
+from utils.llm_utils import RateLimiter
+from utils.user_partitions import DEFAULT_USER_ID, get_user_partition
+
+INDEX_CHUNK_SIZE = 50
+INDEX_MAX_WORKERS = int(os.getenv("INDEX_MAX_WORKERS", "4"))
+INDEX_REQUESTS_PER_MINUTE = float(os.getenv("INDEX_REQUESTS_PER_MINUTE", "120"))
+# attempts per chunk before it is left for the next run
+INDEX_CHUNK_ATTEMPTS = 3
+CHECKPOINT_FILE_NAME = "bulk_index_checkpoint.jsonl"
+
+
+def entry_document(diary_entry: Dict) -> Document:
+    return Document(
+        page_content=diary_entry["entry_content"] or "",
+        metadata=dict(
+            entry=diary_entry["entry"],
+            current_state=diary_entry["current_state"],
+            desired_state=diary_entry["desired_state"],
+            date=diary_entry["entry_date"],
+            title=diary_entry["entry_title"],
+            mental_tendencies=diary_entry["mental_tendencies"],
+            emotions=diary_entry["emotions"],
+            key_topics=diary_entry["key_topics"],
+            reflection_questions=diary_entry["reflection_questions"],
+        ),
+    )
+
+
+def _iter_entry_chunks(
+    db_path: str, chunk_size: int, entries: Optional[pd.DataFrame] = None
+) -> Iterator[List[Dict]]:
+    """
+    Entries in chunks of chunk_size, paged out of the journal store so only one chunk of rows is
+    in memory at a time
+    """
+    if entries is not None:
+        rows = entries.to_dict("records")
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i : i + chunk_size]
+        return
+
+    offset = 0
+    while True:
+        chunk = js.read_entries(limit=chunk_size, offset=offset, db_path=db_path).to_dict("records")
+        if not chunk:
+            return
+        yield chunk
+        offset += len(chunk)
+
+
+def _load_checkpoint(checkpoint_path: str, model_name: str) -> Dict[str, Dict]:
+    """
+    Embedded entries of an earlier, interrupted run by entry id. Entries embedded with another
+    model than model_name (e.g. before EMBEDDING_BACKEND changed) are left out to be embedded
+    again, vectors of different models must not end up in one index.
+    """
+    done, stale = {}, 0
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # partially written chunk
+                    break
+                for record in json.loads(line):
+                    if record.get("model") == model_name:
+                        done[record["entry"]] = record
+                    else:
+                        done.pop(record["entry"], None)
+                        stale += 1
+    if stale:
+        print(f"re-embedding {stale} checkpointed entries embedded with another model")
+    return done
+
+
+def _embed_chunk(chunk: List[Dict], embeddings, rate_limiter: RateLimiter) -> List[Dict]:
+    documents = [entry_document(diary_entry) for diary_entry in chunk]
+    for attempt in range(INDEX_CHUNK_ATTEMPTS):
+        rate_limiter.wait()
+        try:
+            vectors = embeddings.embed_documents([d.page_content for d in documents])
+            break
+        except Exception:
+            if attempt == INDEX_CHUNK_ATTEMPTS - 1:
+                raise
+            time.sleep(2**attempt)
+
+    return [
+        {
+            "entry": str(document.metadata["entry"]),
+            "text": document.page_content,
+            "metadata": document.metadata,
+            "vector": jq.encode_vector(vector),
+            "model": embeddings.model_name,
+        }
+        for document, vector in zip(documents, vectors)
+    ]
+
+
+def _indexed_entry_ids(index_path: str) -> set:
+    manifest = journal_shards.read_manifest(index_path)
+    entry_ids = set()
+    for key in manifest["shards"]:
+        db = jq.get_db(index_path=journal_shards.shard_path(key, index_path))
+        entry_ids.update(str(d.metadata.get("entry")) for d in db.docstore._dict.values())
+    return entry_ids
+
+
+def bulk_index_entries(
+    partition=None,
+    entries: Optional[pd.DataFrame] = None,
+    merge: bool = False,
+    chunk_size: int = INDEX_CHUNK_SIZE,
+    max_workers: int = INDEX_MAX_WORKERS,
+    requests_per_minute: float = INDEX_REQUESTS_PER_MINUTE,
+    resume: bool = True,
+) -> Dict:
+    """
+    Indexes journal entries into the vector store of partition (the default user when not
+    given), defaults to every entry of its journal store.
+
+    Entries are read chunk_size at a time and each chunk is embedded in one batched request,
+    with up to max_workers requests in flight under a rate limit. Every embedded chunk is
+    appended to a checkpoint file, so a failed or interrupted run resumes with the chunks that
+    are left when called again. Once every entry is embedded the index is rebuilt from the
+    checkpoint, or with merge=True the entries not indexed yet are added to the existing index.
+    """
+    partition = partition or get_user_partition()
+    index_path = partition.index_path
+    checkpoint_path = os.path.join(index_path, CHECKPOINT_FILE_NAME)
+    if not resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    os.makedirs(index_path, exist_ok=True)
+
+    embeddings = get_embeddings()
+    done = _load_checkpoint(checkpoint_path, embeddings.model_name)
+    skip = _indexed_entry_ids(index_path) if merge else set()
+    rate_limiter = RateLimiter(requests_per_minute)
+
+    start = time.perf_counter()
+    embedded, failed_chunks, total = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+
+        def collect(futures):
+            nonlocal embedded, failed_chunks
+            for future in futures:
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(f"failed to embed chunk: {str(e)}")
+                    failed_chunks += 1
+                    continue
+                with open(checkpoint_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(records, default=str) + "\n")
+                done.update((record["entry"], record) for record in records)
+                embedded += len(records)
+                elapsed = time.perf_counter() - start
+                print(f"embedded {embedded} entries, {embedded / elapsed:.1f} entries/s")
+
+        for chunk in _iter_entry_chunks(partition.journal_db_path, chunk_size, entries):
+            total += len(chunk)
+            chunk = [
+                diary_entry
+                for diary_entry in chunk
+                if str(diary_entry["entry"]) not in done and str(diary_entry["entry"]) not in skip
+            ]
+            if not chunk:
+                continue
+            in_flight.add(executor.submit(_embed_chunk, chunk, embeddings, rate_limiter))
+            # bounded, so rows are not read much faster than they are embedded
+            if len(in_flight) >= 2 * max_workers:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(in_flight)
+
+    embed_seconds = time.perf_counter() - start
+    if failed_chunks:
+        return {
+            "status": "incomplete",
+            "message": f"{failed_chunks} chunks failed to embed, run again to resume.",
+            "entries_per_second": embedded / max(embed_seconds, 1e-9),
+        }
+
+    records = [record for record in done.values() if not merge or record["entry"] not in skip]
+    documents = [Document(page_content=r["text"], metadata=r["metadata"]) for r in records]
+    vectors = [jq.decode_vector(record["vector"]) for record in records]
+    if merge:
+        if documents:
+            journal_shards.add_documents(documents, embeddings, index_path, vectors)
+    else:
+        journal_shards.rebuild_shards(documents, embeddings, index_path, vectors=vectors)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    seconds = time.perf_counter() - start
+    return {
+        "status": "success",
+        "message": f"Indexed {len(documents)} of {total} entries in {seconds:.1f}s.",
+        "entries_per_second": embedded / max(embed_seconds, 1e-9),
+    }
+
+
+if __name__ == "__main__":
+    for user_id in sys.argv[1:] or [DEFAULT_USER_ID]:
+        print(bulk_index_entries(get_user_partition(user_id)))
@@ -0,0 +1,250 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from typing import List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# "google" (text-embedding-004, needs network) or "hashing" (local, CPU only)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "google")
+EMBEDDING_MODEL = "models/text-embedding-004"
+HASHING_DIMENSIONS = int(os.getenv("HASHING_DIMENSIONS", "768"))
+HASHING_BATCH_SIZE = 256
+# dense relevance (1 - squared L2 distance / sqrt(2), as computed by the vector store) below which
+# an entry is not related to a query. text-embedding-004 scores every pair of the repository's
+# journal entries between 0.45 and 0.78: entries on different subjects (sparring vs. coding) stay
+# below 0.6, entries on the same subject (the three coding entries) score above 0.7. Unrelated
+# texts are about orthogonal under the hashing encoder, i.e. at about 1 - sqrt(2); -0.25 keeps
+# hashing matches with a cosine similarity above about 0.12, which unrelated journal entries of
+# similar length rarely reach.
+SCORE_THRESHOLDS = {"google": 0.6, "hashing": -0.25}
+EMBEDDING_CACHE_PATH = "embedding_cache/embeddings.db"
+EMBEDDING_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings client with a persistent cache keyed by (model name, text hash).
+
+    Vectors are stored as packed float32 blobs in a local SQLite file. Once the stored vectors
+    exceed max_bytes, the least recently used ones are evicted. Documents and queries are cached
+    separately since the underlying model embeds them with different task types.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model_name: str,
+        cache_path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    def _key(self, kind: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.model_name}:{kind}:{digest}"
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for key in set(keys):
+                row = self._conn.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    found[key] = array("f", row[0]).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, items: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+        while total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", [(k,) for k, _ in rows])
+            total_bytes -= sum(size for _, size in rows)
+
+    def _embed(self, kind: str, texts: List[str], embed_fn) -> List[List[float]]:
+        keys = [self._key(kind, text) for text in texts]
+        cached = self._lookup(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            new_items = dict(zip(missing.keys(), vectors))
+            self._store(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed("document", texts, self.underlying.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed("query", [text], lambda t: [self.underlying.embed_query(t[0])])[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": total_bytes,
+        }
+
+
+_WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Local sentence encoder based on feature hashing. Words, word pairs and character trigrams are
+    hashed into a fixed number of signed buckets, counts are log scaled and every vector is L2
+    normalized. Needs no model download or network, and embeds a batch of texts in a few
+    milliseconds on CPU. Vectors are deterministic across processes and machines.
+    """
+
+    def __init__(self, dimensions: int = HASHING_DIMENSIONS, batch_size: int = HASHING_BATCH_SIZE):
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+
+    @property
+    def model_name(self) -> str:
+        return f"hashing-v1-{self.dimensions}"
+
+    @staticmethod
+    def _features(text: str) -> List[str]:
+        words = _WORD_PATTERN.findall(str(text or "").lower())
+        features = [f"w:{word}" for word in words]
+        features += [f"b:{first} {second}" for first, second in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                bucket = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                columns.append(bucket % self.dimensions)
+                signs.append(1.0 if (bucket // self.dimensions) & 1 else -1.0)
+
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(vectors, (rows, columns), signs)
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [
+            self._embed_batch(texts[i : i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        if not vectors:
+            return []
+        return np.concatenate(vectors).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
+
+
+def _google_backend() -> Tuple[Embeddings, str]:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), EMBEDDING_MODEL
+
+
+def _hashing_backend() -> Tuple[Embeddings, str]:
+    embeddings = HashingEmbeddings()
+    return embeddings, embeddings.model_name
+
+
+# backend name -> factory returning the embeddings client and the model name it is cached under
+EMBEDDING_BACKENDS = {
+    "google": _google_backend,
+    "hashing": _hashing_backend,
+}
+
+
+def create_embeddings(backend: str = EMBEDDING_BACKEND) -> "CachedEmbeddings":
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {backend!r}, expected one of {sorted(EMBEDDING_BACKENDS)}"
+        )
+    underlying, model_name = EMBEDDING_BACKENDS[backend]()
+    return CachedEmbeddings(underlying, model_name=model_name)
+
+
+def default_score_threshold(backend: str = EMBEDDING_BACKEND) -> float:
+    return SCORE_THRESHOLDS[backend]
+
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings():
+    """
+    Returns the process-wide cached embeddings client of the configured EMBEDDING_BACKEND
+    """
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            _embeddings = create_embeddings()
+    return _embeddings
@@ -0,0 +1,289 @@
+import math
+import re
+import threading
+import weakref
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.journal_store import parse_entry_date, parse_labels
+from utils.label_codec import LABEL_CODECS
+
+# weight of the BM25 score in the fused score, the dense relevance gets the rest
+LEXICAL_WEIGHT = 0.3
+# approximate memory of one (term, document) posting in the nested postings dicts
+POSTING_BYTES = 100
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = set(
+    (
+        "a an and are as at be but by for i in is it me my of on or so that the this to was "
+        "with you"
+    ).split()
+)
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token for token in _TOKEN_PATTERN.findall(str(text or "").lower()) if token not in STOPWORDS
+    ]
+
+
+def document_date(metadata: Dict) -> Optional[str]:
+    """
+    "YYYY-MM-DD" date of a vector store document, None if it has no usable date
+    """
+    # entries indexed in bulk store "date", entries added from the chat store "entry_date"
+    return parse_entry_date(metadata.get("entry_date") or metadata.get("date"))
+
+
+class HybridIndex:
+    """
+    In-memory inverted index (for BM25) and metadata index (entry date and label bitmasks) over
+    the documents of a FAISS vector store, addressed by the position of each vector in the
+    FAISS index. Documents added to the vector store later are indexed on the next search.
+    """
+
+    def __init__(self, db, db_lock=None):
+        # weak, so the index does not keep the vector store it belongs to alive
+        self._db = weakref.ref(db)
+        # lock the writers of the vector store hold, documents are read from it under this lock
+        self._db_lock = db_lock or threading.RLock()
+        self.postings = defaultdict(dict)
+        self.doc_lengths = []
+        self.dates = np.empty(0, dtype="datetime64[D]")
+        self.masks = {label_type: np.empty(0, dtype=np.int64) for label_type in LABEL_CODECS}
+        self.num_postings = 0
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        return self._db()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def estimated_bytes(self) -> int:
+        """
+        Approximate memory held by the index, on top of the vector store it belongs to
+        """
+        array_bytes = self.dates.nbytes + sum(masks.nbytes for masks in self.masks.values())
+        return self.num_postings * POSTING_BYTES + 8 * len(self) + array_bytes
+
+    def refresh(self):
+        with self._lock:
+            self._index_new_documents()
+
+    def _index_new_documents(self):
+        db = self.db
+        with self._db_lock:
+            start, end = len(self), db.index.ntotal
+            documents = [
+                db.docstore.search(db.index_to_docstore_id[position])
+                for position in range(start, end)
+            ]
+        if not documents:
+            return
+
+        dates, masks = [], {label_type: [] for label_type in LABEL_CODECS}
+        for position, document in enumerate(documents, start):
+            tokens = tokenize(document.page_content)
+            for term, frequency in Counter(tokens).items():
+                self.postings[term][position] = frequency
+                self.num_postings += 1
+            self.doc_lengths.append(len(tokens))
+            dates.append(np.datetime64(document_date(document.metadata) or "NaT", "D"))
+            for label_type, codec in LABEL_CODECS.items():
+                masks[label_type].append(
+                    codec.encode(parse_labels(document.metadata.get(label_type)))
+                )
+
+        self.dates = np.concatenate([self.dates, np.array(dates, dtype="datetime64[D]")])
+        for label_type in LABEL_CODECS:
+            self.masks[label_type] = np.concatenate(
+                [self.masks[label_type], np.array(masks[label_type], dtype=np.int64)]
+            )
+
+    def candidates(
+        self,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        labels: Optional[Dict[str, List[str]]] = None,
+    ) -> np.ndarray:
+        """
+        Positions of the documents within the date range that carry all of the given labels.
+        Reads the index arrays, so callers hold self._lock.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if start_date:
+            keep &= self.dates >= np.datetime64(str(start_date)[:10], "D")
+        if end_date:
+            keep &= self.dates <= np.datetime64(str(end_date)[:10], "D")
+        for label_type, label_values in (labels or {}).items():
+            keep &= LABEL_CODECS[label_type].filter(self.masks[label_type], label_values)
+        return np.flatnonzero(keep)
+
+    def bm25(self, query: str, positions: np.ndarray) -> np.ndarray:
+        """
+        BM25 score of each candidate for the query. Reads the postings, so callers hold
+        self._lock.
+        """
+        doc_lengths = np.asarray(self.doc_lengths, dtype=np.float64)
+        average_length = doc_lengths.mean() if len(doc_lengths) else 0.0
+        lengths = doc_lengths[positions]
+        scores = np.zeros(len(positions))
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self) - len(postings) + 0.5) / (len(postings) + 0.5))
+            frequencies = np.zeros(len(self))
+            frequencies[list(postings)] = list(postings.values())
+            frequencies = frequencies[positions]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(average_length, 1e-9))
+            scores += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+        return scores
+
+    def dense(self, query_vector, positions: np.ndarray) -> np.ndarray:
+        """
+        Relevance of each candidate to the query, on the same 0-1 scale as the vector store
+        """
+        with self._db_lock:
+            # only the candidates' vectors are copied out of the FAISS index
+            vectors = self.db.index.reconstruct_batch(positions.astype(np.int64))
+        differences = vectors - np.asarray(query_vector, dtype=np.float32)
+        # IndexFlatL2 distances are squared, the relevance function expects them that way
+        distances = np.einsum("ij,ij->i", differences, differences)
+        relevance = self.db._select_relevance_score_fn()
+        # the relevance functions are plain arithmetic, so they apply to the whole array at once
+        return np.asarray(relevance(distances), dtype=np.float64)
+
+    def score(
+        self,
+        query: str,
+        k: int,
+        query_vector=None,
+        score_threshold: float = 0,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        labels: Optional[Dict[str, List[str]]] = None,
+        lexical_weight: float = LEXICAL_WEIGHT,
+    ) -> List[Tuple]:
+        """
+        Top k (document, dense relevance, BM25 score) triples, ranked by their fused score within
+        this index. Filters narrow the candidates before anything is scored; candidates below
+        score_threshold dense relevance are dropped. The scores are returned unfused, so that the
+        results of several indexes can be fused over their merged set (see merge_scored).
+        """
+        # another session may be indexing new documents, which grows the postings before
+        # doc_lengths, so the lexical side is scored under the same lock
+        with self._lock:
+            self._index_new_documents()
+            positions = self.candidates(start_date, end_date, labels)
+            lexical_scores = self.bm25(query, positions)
+        if not len(positions):
+            return []
+
+        if query_vector is None:
+            query_vector = self.db._embed_query(query)
+        dense_scores = self.dense(query_vector, positions)
+
+        keep = dense_scores >= score_threshold
+        positions, dense_scores, lexical_scores = (
+            positions[keep],
+            dense_scores[keep],
+            lexical_scores[keep],
+        )
+        top = np.argsort(-fuse_scores(dense_scores, lexical_scores, lexical_weight))[:k]
+        db = self.db
+        with self._db_lock:
+            return [
+                (
+                    db.docstore.search(db.index_to_docstore_id[int(positions[i])]),
+                    dense_scores[i],
+                    lexical_scores[i],
+                )
+                for i in top
+            ]
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        score_threshold: float = 0,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        labels: Optional[Dict[str, List[str]]] = None,
+        lexical_weight: float = LEXICAL_WEIGHT,
+    ):
+        """
+        Top k (document, fused score) pairs, see score
+        """
+        scored = self.score(
+            query,
+            k,
+            score_threshold=score_threshold,
+            start_date=start_date,
+            end_date=end_date,
+            labels=labels,
+            lexical_weight=lexical_weight,
+        )
+        return merge_scored(scored, k, lexical_weight)
+
+
+def fuse_scores(
+    dense_scores: np.ndarray, lexical_scores: np.ndarray, lexical_weight: float = LEXICAL_WEIGHT
+) -> np.ndarray:
+    """
+    Weighted sum of the dense relevance and the BM25 score, the BM25 scores being scaled to 0-1
+    by their maximum over the given candidates
+    """
+    if len(lexical_scores) and lexical_scores.max() > 0:
+        lexical_scores = lexical_scores / lexical_scores.max()
+    return (1 - lexical_weight) * dense_scores + lexical_weight * lexical_scores
+
+
+def merge_scored(scored: List[Tuple], k: int, lexical_weight: float = LEXICAL_WEIGHT):
+    """
+    Top k (document, fused score) pairs of (document, dense relevance, BM25 score) triples, e.g.
+    collected from several indexes, fused over all of them so their scores are comparable
+    """
+    if not scored:
+        return []
+    documents, dense_scores, lexical_scores = zip(*scored)
+    scores = fuse_scores(np.array(dense_scores), np.array(lexical_scores), lexical_weight)
+    return [(documents[i], scores[i]) for i in np.argsort(-scores)[:k]]
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_hybrid_index(db, db_lock=None) -> HybridIndex:
+    """
+    The index of db, built on first use. db_lock is the lock writers of db hold.
+    """
+    with _indexes_lock:
+        if db not in _indexes:
+            _indexes[db] = HybridIndex(db, db_lock)
+        return _indexes[db]
+
+
+def hybrid_index_bytes(db) -> int:
+    """
+    Approximate memory of the index of db, 0 while it is not built
+    """
+    with _indexes_lock:
+        index = _indexes.get(db)
+    return index.estimated_bytes() if index is not None else 0
+
+
+def invalidate_hybrid_index(db):
+    """
+    Drops the index of db, e.g. after the metadata of its documents changed
+    """
+    with _indexes_lock:
+        _indexes.pop(db, None)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional, Tuple
+
+from langchain.chains import LLMChain
+from langchain.prompts import PromptTemplate
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+import utils.journal_shards as journal_shards
+import utils.journal_store as js
+from utils.llm_utils import get_sahha_insights
+from utils.sahha_store import get_sahha_store
+from utils.user_partitions import get_user_partition
+
+_generate_lock = threading.Lock()
+_generating = set()
+
+
+def get_data_fingerprint(partition) -> str:
+    """
+    Changes whenever a journal entry of the partition's user is written or the Sahha data files
+    change
+    """
+    versions = {
+        "journal": js.get_data_version(partition.journal_db_path),
+        "sahha": get_sahha_store().data_version(),
+        "sahha_user": partition.sahha_user_id,
+    }
+    return hashlib.sha256(json.dumps(versions).encode("utf-8")).hexdigest()
+
+
+def generate_actionable_insights(partition) -> str:
+    """
+    Asks the llm for actionable insights from past journal entries and Sahha data
+    """
+    model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3)
+    # context is part of the vector store, the most recent shards are searched first
+    past_entries, _ = journal_shards.search_shards(
+        " ", num_of_docs=4, index_path=partition.index_path
+    )
+    context = "\n".join(entry.page_content for entry in past_entries)
+
+    sahha_prompt, _ = get_sahha_insights(1, partition.sahha_user_id)
+
+    prompt_template = f"""
+I want to extract 5 actionable insights from the following data. Each point should be less than 20 words.
+These are some of my past journal entries: {context}.
+And this is some data of my daily activities: {sahha_prompt}
+"""
+    prompt = PromptTemplate(template=prompt_template, input_variables=["context", "sahha_prompt"])
+    chain = LLMChain(llm=model, prompt=prompt)
+    return chain.run({"context": context, "sahha_prompt": sahha_prompt})
+
+
+def _read_cache(cache_path: str) -> Optional[dict]:
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def refresh_actionable_insights(partition=None) -> str:
+    """
+    Generates the insights for the current data of the partition's user (the default user when
+    not given) and stores them with their fingerprint. Does nothing but return the cached
+    insights if they are already up to date.
+    """
+    partition = partition or get_user_partition()
+    cache_path = partition.insights_cache_path
+    with _generate_lock:
+        fingerprint = get_data_fingerprint(partition)
+        cached = _read_cache(cache_path)
+        if cached and cached["fingerprint"] == fingerprint:
+            return cached["insights"]
+
+        insights = generate_actionable_insights(partition)
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(f"{cache_path}.tmp", "w") as f:
+            json.dump({"fingerprint": fingerprint, "insights": insights}, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+        return insights
+
+
+def _refresh_in_background(partition):
+    try:
+        refresh_actionable_insights(partition)
+    except Exception as e:
+        print(f"failed to refresh actionable insights: {str(e)}")
+    finally:
+        _generating.discard(partition.insights_cache_path)
+
+
+def get_actionable_insights(partition=None) -> Tuple[Optional[str], bool]:
+    '''
+    Returns the cached insights straight away and, when the journal or Sahha data changed since
+    they were generated, regenerates them in a background thread.
+
+    Output
+    -----
+    insights: the last generated insights, None if they were never generated
+    is_fresh: whether the insights match the current data
+    '''
+    partition = partition or get_user_partition()
+    cache_path = partition.insights_cache_path
+    cached = _read_cache(cache_path)
+    if cached and cached["fingerprint"] == get_data_fingerprint(partition):
+        return cached["insights"], True
+
+    if cached and cache_path not in _generating:
+        _generating.add(cache_path)
+        threading.Thread(target=_refresh_in_background, args=(partition,), daemon=True).start()
+    return (cached["insights"] if cached else None), False
@@ -1,54 +1,369 @@
+import base64
+import json
+import os
+import threading
+import uuid
 import warnings
+from array import array
+from collections import OrderedDict
+
 from langchain_community.vectorstores import FAISS
-import json
 
-def get_db(embeddings):
-    db = FAISS.load_local(
-        "faiss_index", embeddings=embeddings, allow_dangerous_deserialization=True
+from utils.embeddings import get_embeddings
+from utils.hybrid_retriever import (
+    LEXICAL_WEIGHT,
+    get_hybrid_index,
+    hybrid_index_bytes,
+    invalidate_hybrid_index,
+)
+from utils.prompt_assembler import count_tokens, truncate_to_tokens
+
+INDEX_PATH = "faiss_index"
+WAL_FILE_NAME = "wal.jsonl"
+# number of write-ahead log records after which the log is folded into the base index
+COMPACT_AFTER_RECORDS = 50
+
+# upper bound on the approximate memory of the vector stores kept loaded (all users and shards,
+# including their hybrid search indexes), the least recently used stores are dropped first and
+# reloaded from disk when needed again
+MAX_LOADED_INDEX_BYTES = int(os.getenv("MAX_LOADED_INDEX_BYTES", str(512 * 1024 * 1024)))
+
+# One vector store handle per index directory, shared by every caller in the process, in least
+# recently used order. Each entry holds the db, the on-disk fingerprint of the base index it was
+# loaded from, how far into the write-ahead log it has been replayed and its approximate size.
+_db_cache = OrderedDict()
+_db_lock = threading.RLock()
+_cache_metrics = {"hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+_compacting = set()
+
+# metadata that is not worth spending prompt tokens on when passing entries to the chatbot
+LOW_VALUE_METADATA = {"entry", "reflection_questions"}
+
+
+def get_index_version(index_path: str = INDEX_PATH):
+    """
+    Fingerprint of the on-disk index, changes whenever index.faiss or index.pkl is rewritten
+    """
+    version = []
+    for file_name in ("index.faiss", "index.pkl"):
+        try:
+            stat = os.stat(os.path.join(index_path, file_name))
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+def _wal_path(index_path: str):
+    return os.path.join(index_path, WAL_FILE_NAME)
+
+
+def _wal_size(index_path: str):
+    try:
+        return os.path.getsize(_wal_path(index_path))
+    except FileNotFoundError:
+        return 0
+
+
+def encode_vector(vector):
+    return base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+
+
+def decode_vector(encoded):
+    return array("f", base64.b64decode(encoded)).tolist()
+
+
+def _add_wal_records(db, records):
+    known_ids = set(db.index_to_docstore_id.values())
+    records = [record for record in records if record["id"] not in known_ids]
+    if records:
+        db.add_embeddings(
+            text_embeddings=[(r["text"], decode_vector(r["vector"])) for r in records],
+            metadatas=[r["metadata"] for r in records],
+            ids=[r["id"] for r in records],
+        )
+
+
+def _estimate_db_bytes(db) -> int:
+    vector_bytes = db.index.ntotal * db.index.d * 4
+    document_bytes = sum(
+        len(document.page_content) + len(json.dumps(document.metadata, default=str))
+        for document in db.docstore._dict.values()
+    )
+    return vector_bytes + document_bytes
+
+
+def _cache_entry(db, version):
+    return {
+        "version": version,
+        "db": db,
+        "wal_offset": 0,
+        "wal_records": 0,
+        "bytes": _estimate_db_bytes(db),
+    }
+
+
+def _loaded_bytes(cached) -> int:
+    # the hybrid search index built over the store is dropped along with it
+    return cached["bytes"] + hybrid_index_bytes(cached["db"])
+
+
+def _evict(keep_index_path: str):
+    """
+    Drops least recently used stores until the loaded stores fit in MAX_LOADED_INDEX_BYTES
+    """
+    loaded_bytes = {index_path: _loaded_bytes(cached) for index_path, cached in _db_cache.items()}
+    total_bytes = sum(loaded_bytes.values())
+    for index_path in list(_db_cache):
+        if total_bytes <= MAX_LOADED_INDEX_BYTES:
+            break
+        if index_path == keep_index_path or index_path in _compacting:
+            continue
+        del _db_cache[index_path]
+        total_bytes -= loaded_bytes[index_path]
+        _cache_metrics["evictions"] += 1
+        _cache_metrics["evicted_bytes"] += loaded_bytes[index_path]
+
+
+def cache_stats():
+    """
+    Loaded vector stores and their approximate size, with hit, miss and eviction counts
+    """
+    with _db_lock:
+        return {
+            "loaded_stores": len(_db_cache),
+            "loaded_bytes": sum(_loaded_bytes(cached) for cached in _db_cache.values()),
+            "max_bytes": MAX_LOADED_INDEX_BYTES,
+            **_cache_metrics,
+        }
+
+
+def _replay_wal(cached, index_path: str):
+    """
+    Applies write-ahead log records written after cached["wal_offset"] to the cached db
+    """
+    if _wal_size(index_path) <= cached["wal_offset"]:
+        return
+
+    records = []
+    with open(_wal_path(index_path), "rb") as f:
+        f.seek(cached["wal_offset"])
+        for line in f:
+            if not line.endswith(b"\n"):
+                # partially written record, picked up on the next replay
+                break
+            cached["wal_offset"] += len(line)
+            cached["bytes"] += len(line)
+            records.append(json.loads(line))
+
+    _add_wal_records(cached["db"], records)
+    cached["wal_records"] += len(records)
+
+
+def get_db(embeddings=None, index_path: str = INDEX_PATH):
+    """
+    Returns the shared vector store for index_path. The base index is only reloaded from disk
+    when it was rewritten since the last load, new write-ahead log records are applied in place.
+    """
+    with _db_lock:
+        version = get_index_version(index_path)
+        cached = _db_cache.get(index_path)
+        if cached is None or cached["version"] != version:
+            _cache_metrics["misses"] += 1
+            db = FAISS.load_local(
+                index_path,
+                embeddings=embeddings or get_embeddings(),
+                allow_dangerous_deserialization=True,
+            )
+            cached = _cache_entry(db, version)
+            _db_cache[index_path] = cached
+        else:
+            _cache_metrics["hits"] += 1
+
+        _replay_wal(cached, index_path)
+        _db_cache.move_to_end(index_path)
+        _evict(index_path)
+        return cached["db"]
+
+
+def save_db(db, index_path: str = INDEX_PATH):
+    """
+    Persists db as the new base index and makes it the shared handle for index_path.
+    The write-ahead log is dropped since db already contains its records.
+    """
+    with _db_lock:
+        db.save_local(index_path)
+        if os.path.exists(_wal_path(index_path)):
+            os.remove(_wal_path(index_path))
+        _db_cache[index_path] = _cache_entry(db, get_index_version(index_path))
+        _db_cache.move_to_end(index_path)
+        _evict(index_path)
+
+
+def compact_db(index_path: str = INDEX_PATH):
+    """
+    Folds the write-ahead log into the base index
+    """
+    try:
+        with _db_lock:
+            save_db(get_db(index_path=index_path), index_path)
+    finally:
+        _compacting.discard(index_path)
+
+
+def _maybe_compact_in_background(index_path: str):
+    cached = _db_cache[index_path]
+    if cached["wal_records"] >= COMPACT_AFTER_RECORDS and index_path not in _compacting:
+        _compacting.add(index_path)
+        threading.Thread(target=compact_db, args=(index_path,), daemon=True).start()
+
+
+def add_documents_to_db(documents, embeddings=None, index_path: str = INDEX_PATH, vectors=None):
+    """
+    Adds documents to the shared vector store in place. The new vectors and docstore records are
+    appended to a write-ahead log instead of rewriting the whole index, so the cost of a write
+    does not grow with the size of the journal. Pass vectors when the documents are already
+    embedded.
+    """
+    embeddings = embeddings or get_embeddings()
+    if vectors is None:
+        vectors = embeddings.embed_documents([document.page_content for document in documents])
+    wal_lines = "".join(
+        json.dumps(
+            {
+                "id": str(uuid.uuid4()),
+                "text": document.page_content,
+                "metadata": document.metadata,
+                "vector": encode_vector(vector),
+            },
+            default=str,
         )
-    return db     
-    
-def get_docs_with_query(db, query: str, num_of_docs: int, score_threshold: float = 0):
+        + "\n"
+        for document, vector in zip(documents, vectors)
+    )
+
+    with _db_lock:
+        db = get_db(embeddings, index_path)
+        with open(_wal_path(index_path), "a", encoding="utf-8") as f:
+            f.write(wal_lines)
+            f.flush()
+            os.fsync(f.fileno())
+        _replay_wal(_db_cache[index_path], index_path)
+        _maybe_compact_in_background(index_path)
+    return db
+
+
+def update_documents_metadata(updates, index_path: str = INDEX_PATH):
+    """
+    Merges updates[entry_id] into the metadata of the matching documents and persists the index
+    once for the whole batch
+    """
+    with _db_lock:
+        db = get_db(index_path=index_path)
+        for document in db.docstore._dict.values():
+            entry_id = str(document.metadata.get("entry"))
+            if entry_id in updates:
+                document.metadata.update(updates[entry_id])
+        invalidate_hybrid_index(db)
+        save_db(db, index_path)
+
+
+def get_docs_with_query(
+    db,
+    query: str,
+    num_of_docs: int,
+    score_threshold: float = 0,
+    start_date: str = None,
+    end_date: str = None,
+    labels=None,
+    lexical_weight: float = LEXICAL_WEIGHT,
+):
     '''
+    Hybrid search: entries are first narrowed down by date and labels, then ranked by a mix of
+    their BM25 score for the query and their embedding relevance.
+
     Input
     -----
     Query: A string that will be used to calculate an embedding for search
     num_of_docs: An integer representing how many journal entries we want to retrieve
     score_threshold: A floating point value between 0 to 1 to filter the resulting set of retrieved docs. Deafult: 0s
-    
+    start_date / end_date: inclusive "YYYY-MM-DD" bounds on the entry date
+    labels: only keep entries tagged with all of the given labels, e.g. {"key_topics": ["Work and Career"]}
+    lexical_weight: share of the BM25 score in the fused score, 0 for a pure vector search
+
     Output
     -----
     docs: a list of langchain Document Objects
-    thresholds: a list of thresholds matching the document objects
+    thresholds: a list of fused scores matching the document objects
     '''
-    docs = db.similarity_search_with_relevance_scores(query, K=num_of_docs, score_threshold = score_threshold)
-    
+    docs = get_hybrid_index(db, _db_lock).search(
+        query,
+        k=num_of_docs,
+        score_threshold=score_threshold,
+        start_date=start_date,
+        end_date=end_date,
+        labels=labels,
+        lexical_weight=lexical_weight,
+    )
+
     if len(docs) == 0:
         warnings.warn("Warning: No documents were retrieved. consider lowering the score threshold")
         return [], []
-    else:    
+    else:
         docs_list, thresholds = zip(*docs)
         return docs_list, thresholds
-    
-def format_docs(docs, sims):
+
+def get_scored_docs(
+    db,
+    query: str,
+    num_of_docs: int,
+    query_vector=None,
+    score_threshold: float = 0,
+    start_date: str = None,
+    end_date: str = None,
+    labels=None,
+    lexical_weight: float = LEXICAL_WEIGHT,
+):
     '''
-    This function takes in a list of Langchain Documents and outputs a dictionary
+    Like get_docs_with_query, but returns (document, dense relevance, BM25 score) triples with
+    the scores unfused, for merging the results of several vector stores with
+    utils.hybrid_retriever.merge_scored. Pass query_vector to reuse one query embedding.
+    '''
+    return get_hybrid_index(db, _db_lock).score(
+        query,
+        k=num_of_docs,
+        query_vector=query_vector,
+        score_threshold=score_threshold,
+        start_date=start_date,
+        end_date=end_date,
+        labels=labels,
+        lexical_weight=lexical_weight,
+    )
+
+def format_docs(docs, sims, max_tokens: int = None, max_entry_tokens: int = 300):
+    '''
+    This function takes in a list of Langchain Documents and outputs a compact json string.
+    Low value metadata is dropped and each journal entry is truncated to max_entry_tokens.
+    Contexts are added in order until max_tokens is reached.
     '''
-    #TODO: update filter to remove unecessary metadata
     db_context_string = {}
+    used_tokens = 0
     for i in range(len(docs)):
-        if len(docs) == 0:
-            doc_string = {}
-        else:
-            metadata = docs[i].metadata
-            del metadata['entry']
-
-            doc_string = {
-                #'relevance(0-1)': sims[i],
-                'metadata': metadata,
-                'journal_entry': docs[i].page_content
-            }
+        metadata = {
+            key: value
+            for key, value in docs[i].metadata.items()
+            if key not in LOW_VALUE_METADATA and value not in (None, "", "[]")
+        }
+
+        doc_string = {
+            #'relevance(0-1)': sims[i],
+            'metadata': metadata,
+            'journal_entry': truncate_to_tokens(docs[i].page_content, max_entry_tokens)
+        }
+        doc_tokens = count_tokens(json.dumps(doc_string, separators=(",", ":"), default=str))
+        if max_tokens is not None and used_tokens + doc_tokens > max_tokens:
+            break
+        used_tokens += doc_tokens
         db_context_string[f'context{i+1}'] = doc_string
-    db_context_string = json.dumps(db_context_string, indent=2)
+    db_context_string = json.dumps(db_context_string, separators=(",", ":"), default=str)
     return db_context_string
-    
\ No newline at end of file
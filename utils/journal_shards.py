@@ -0,0 +1,325 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, List
+
+from langchain_community.vectorstores import FAISS
+
+import utils.journal_query as jq
+from utils.embeddings import EMBEDDING_MODEL, default_score_threshold, get_embeddings
+from utils.hybrid_retriever import LEXICAL_WEIGHT, document_date, merge_scored
+
+SHARDS_DIR_NAME = "shards"
+MANIFEST_FILE_NAME = "manifest.json"
+# "month" or "quarter", how much of the journal goes into one shard
+SHARD_GRANULARITY = os.getenv("SHARD_GRANULARITY", "month")
+# shard for documents without a usable date, searched after every dated shard
+UNDATED_SHARD = "undated"
+# bumped when the shard layout of older manifests has to be fixed up, see read_manifest
+MANIFEST_VERSION = 2
+
+_manifest_lock = threading.RLock()
+
+
+def shard_key(metadata: Dict, granularity: str = SHARD_GRANULARITY) -> str:
+    date = document_date(metadata)
+    if date is None:
+        return UNDATED_SHARD
+    if granularity == "quarter":
+        return f"{date[:4]}-Q{(int(date[5:7]) - 1) // 3 + 1}"
+    return date[:7]
+
+
+def _manifest_path(index_path: str):
+    return os.path.join(index_path, MANIFEST_FILE_NAME)
+
+
+def shard_path(key: str, index_path: str = jq.INDEX_PATH):
+    return os.path.join(index_path, SHARDS_DIR_NAME, key)
+
+
+def read_manifest(index_path: str = jq.INDEX_PATH) -> Dict:
+    '''
+    Output
+    -----
+    {"version": ..., "granularity": ..., "embedding_model": ..., "shards": {key: {"count",
+    "first_date", "last_date"}}}, the shards of a journal without a manifest are migrated from
+    the single index first (see migrate_legacy_index)
+    '''
+    with _manifest_lock:
+        if not os.path.exists(_manifest_path(index_path)):
+            migrate_legacy_index(index_path)
+        with open(_manifest_path(index_path)) as f:
+            manifest = json.load(f)
+        if manifest.get("version", 1) < MANIFEST_VERSION:
+            manifest = _upgrade_manifest(manifest, index_path)
+        return manifest
+
+
+def _upgrade_manifest(manifest: Dict, index_path: str) -> Dict:
+    """
+    Manifests before version 2 were written when only "YYYY-MM-DD" dates were understood, so
+    documents with legacy dates (e.g. "Jun 4, 2024") ended up in the undated shard, which is
+    searched last. Moves them into the shards of their dates. Those manifests also left the
+    embedding model of a migrated single index unknown, which always was text-embedding-004.
+    """
+    if manifest.get("embedding_model") is None and manifest["shards"]:
+        manifest["embedding_model"] = EMBEDDING_MODEL
+    if UNDATED_SHARD in manifest["shards"]:
+        path = shard_path(UNDATED_SHARD, index_path)
+        db = jq.get_db(index_path=path)
+        ids = [db.index_to_docstore_id[position] for position in range(db.index.ntotal)]
+        documents = [db.docstore.search(docstore_id) for docstore_id in ids]
+        vectors = [vector.tolist() for vector in db.index.reconstruct_n(0, db.index.ntotal)]
+        if any(document_date(document.metadata) for document in documents):
+            del manifest["shards"][UNDATED_SHARD]
+            shutil.rmtree(path, ignore_errors=True)
+            _add_to_shards(manifest, documents, vectors, get_embeddings(), index_path)
+            print(f"Moved {len(documents)} undated documents into the shards of their dates")
+
+    manifest["version"] = MANIFEST_VERSION
+    _write_manifest(manifest, index_path)
+    return manifest
+
+
+def _check_embedding_model(manifest: Dict, embeddings):
+    """
+    Vectors of different embedding models can not be compared, an index built with another model
+    has to be re-embedded first
+    """
+    index_model = manifest.get("embedding_model")
+    model_name = getattr(embeddings, "model_name", None)
+    if manifest["shards"] and (index_model is None or index_model != model_name):
+        raise ValueError(
+            f"The journal index was embedded with {index_model or 'an unknown model'}, "
+            f"not {model_name}. Run `python -m utils.reembed` to re-embed it with the "
+            "configured backend."
+        )
+
+
+def _write_manifest(manifest: Dict, index_path: str):
+    os.makedirs(index_path, exist_ok=True)
+    path = _manifest_path(index_path)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _record_documents(manifest: Dict, key: str, metadatas: List[Dict]):
+    shard = manifest["shards"].setdefault(key, {"count": 0, "first_date": None, "last_date": None})
+    shard["count"] += len(metadatas)
+    dates = [date for date in map(document_date, metadatas) if date]
+    if dates:
+        shard["first_date"] = min(filter(None, [shard["first_date"], *dates]))
+        shard["last_date"] = max(filter(None, [shard["last_date"], *dates]))
+
+
+def _group_by_shard(items, metadata_of, granularity: str):
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_key(metadata_of(item), granularity), []).append(item)
+    return groups
+
+
+def _write_shards(
+    text_embeddings, metadatas, ids, index_path: str, granularity: str, embedding_model
+) -> Dict:
+    """
+    Replaces every shard of index_path with the given documents, already embedded with
+    embedding_model (None if it is not known)
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "granularity": granularity,
+        "embedding_model": embedding_model,
+        "shards": {},
+    }
+    rows = list(zip(text_embeddings, metadatas, ids))
+    for key, shard_rows in _group_by_shard(rows, lambda row: row[1], granularity).items():
+        shard_text_embeddings, shard_metadatas, shard_ids = map(list, zip(*shard_rows))
+        db = FAISS.from_embeddings(
+            shard_text_embeddings, get_embeddings(), metadatas=shard_metadatas, ids=shard_ids
+        )
+        jq.save_db(db, shard_path(key, index_path))
+        _record_documents(manifest, key, shard_metadatas)
+    _write_manifest(manifest, index_path)
+    return manifest
+
+
+def migrate_legacy_index(index_path: str = jq.INDEX_PATH, granularity: str = SHARD_GRANULARITY):
+    """
+    Splits the single index of index_path (and its write-ahead log) into shards, reusing the
+    stored vectors. The single index files are left in place but are no longer read.
+    """
+    with _manifest_lock:
+        if not os.path.exists(os.path.join(index_path, "index.faiss")):
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "granularity": granularity,
+                "embedding_model": get_embeddings().model_name,
+                "shards": {},
+            }
+            _write_manifest(manifest, index_path)
+            return
+
+        db = jq.get_db(index_path=index_path)
+        ids = [db.index_to_docstore_id[position] for position in range(db.index.ntotal)]
+        documents = [db.docstore.search(docstore_id) for docstore_id in ids]
+        vectors = db.index.reconstruct_n(0, db.index.ntotal)
+        text_embeddings = [
+            (document.page_content, vector.tolist()) for document, vector in zip(documents, vectors)
+        ]
+        metadatas = [document.metadata for document in documents]
+        # the single index predates the embedding backends, it was always embedded with Google
+        manifest = _write_shards(
+            text_embeddings, metadatas, ids, index_path, granularity, EMBEDDING_MODEL
+        )
+        print(f"Split {len(ids)} documents into {len(manifest['shards'])} shards")
+
+
+def rebuild_shards(
+    documents,
+    embeddings=None,
+    index_path: str = jq.INDEX_PATH,
+    granularity: str = SHARD_GRANULARITY,
+    vectors=None,
+) -> Dict:
+    """
+    Replaces the sharded index with documents, embedding them unless their vectors are given
+    """
+    embeddings = embeddings or get_embeddings()
+    if vectors is None:
+        vectors = embeddings.embed_documents([document.page_content for document in documents])
+    text_embeddings = [
+        (document.page_content, vector) for document, vector in zip(documents, vectors)
+    ]
+    metadatas = [document.metadata for document in documents]
+    ids = [str(uuid.uuid4()) for _ in documents]
+    with _manifest_lock:
+        return _write_shards(
+            text_embeddings,
+            metadatas,
+            ids,
+            index_path,
+            granularity,
+            getattr(embeddings, "model_name", None),
+        )
+
+
+def add_documents(documents, embeddings=None, index_path: str = jq.INDEX_PATH, vectors=None):
+    """
+    Adds documents to the shard of their date. Existing shards take the documents through their
+    write-ahead log, so only the shards that receive documents are touched. Pass vectors when
+    the documents are already embedded.
+    """
+    embeddings = embeddings or get_embeddings()
+    if vectors is None:
+        vectors = embeddings.embed_documents([document.page_content for document in documents])
+    with _manifest_lock:
+        manifest = read_manifest(index_path)
+        if not manifest["shards"]:
+            manifest["embedding_model"] = getattr(embeddings, "model_name", None)
+        _check_embedding_model(manifest, embeddings)
+        _add_to_shards(manifest, documents, vectors, embeddings, index_path)
+        _write_manifest(manifest, index_path)
+
+
+def _add_to_shards(manifest: Dict, documents, vectors, embeddings, index_path: str):
+    rows = list(zip(documents, vectors))
+    groups = _group_by_shard(rows, lambda row: row[0].metadata, manifest["granularity"])
+    for key, shard_rows in groups.items():
+        shard_documents, shard_vectors = map(list, zip(*shard_rows))
+        path = shard_path(key, index_path)
+        if key in manifest["shards"]:
+            jq.add_documents_to_db(shard_documents, embeddings, path, shard_vectors)
+        else:
+            db = FAISS.from_embeddings(
+                [(d.page_content, v) for d, v in zip(shard_documents, shard_vectors)],
+                embeddings,
+                metadatas=[document.metadata for document in shard_documents],
+            )
+            jq.save_db(db, path)
+        _record_documents(manifest, key, [document.metadata for document in shard_documents])
+
+
+def update_documents_metadata(updates, index_path: str = jq.INDEX_PATH):
+    """
+    Merges updates[entry_id] into the metadata of the matching documents of every shard
+    """
+    manifest = read_manifest(index_path)
+    for key in manifest["shards"]:
+        path = shard_path(key, index_path)
+        db = jq.get_db(index_path=path)
+        if any(str(d.metadata.get("entry")) in updates for d in db.docstore._dict.values()):
+            jq.update_documents_metadata(updates, path)
+
+
+def _newest_first(manifest: Dict, start_date: str = None, end_date: str = None) -> List[str]:
+    keys = []
+    for key, shard in manifest["shards"].items():
+        if start_date and shard["last_date"] and shard["last_date"] < str(start_date)[:10]:
+            continue
+        if end_date and shard["first_date"] and shard["first_date"] > str(end_date)[:10]:
+            continue
+        keys.append(key)
+    dated = sorted((key for key in keys if key != UNDATED_SHARD), reverse=True)
+    return dated + [key for key in keys if key == UNDATED_SHARD]
+
+
+def search_shards(
+    query: str,
+    num_of_docs: int,
+    score_threshold: float = None,
+    start_date: str = None,
+    end_date: str = None,
+    labels=None,
+    index_path: str = jq.INDEX_PATH,
+    lexical_weight: float = LEXICAL_WEIGHT,
+):
+    '''
+    Searches the shards newest first and stops as soon as num_of_docs documents above
+    score_threshold were found, so older shards are only loaded when recent ones do not have
+    enough matches. That relies on score_threshold separating related from unrelated entries:
+    with a threshold below the relevance of unrelated entries, the newest entries would be
+    returned whatever the query. Shards outside start_date / end_date are skipped without being
+    loaded.
+    The query is embedded once, and the candidates of every searched shard are fused together
+    so that their BM25 scores are scaled over the merged set rather than per shard.
+
+    Input / Output
+    -----
+    Same as utils.journal_query.get_docs_with_query, without the db. score_threshold defaults
+    to the threshold calibrated for the embedding backend (utils.embeddings.SCORE_THRESHOLDS).
+    '''
+    if score_threshold is None:
+        score_threshold = default_score_threshold()
+    manifest = read_manifest(index_path)
+    embeddings = get_embeddings()
+    _check_embedding_model(manifest, embeddings)
+    query_vector = embeddings.embed_query(query)
+    scored = []
+    for key in _newest_first(manifest, start_date, end_date):
+        db = jq.get_db(index_path=shard_path(key, index_path))
+        scored.extend(
+            jq.get_scored_docs(
+                db,
+                query,
+                num_of_docs,
+                query_vector=query_vector,
+                score_threshold=score_threshold,
+                start_date=start_date,
+                end_date=end_date,
+                labels=labels,
+                lexical_weight=lexical_weight,
+            )
+        )
+        if len(scored) >= num_of_docs:
+            break
+
+    results = merge_scored(scored, num_of_docs, lexical_weight)
+    if not results:
+        return [], []
+    docs_list, scores = zip(*results)
+    return docs_list, scores
@@ -0,0 +1,490 @@
+import ast
+import csv
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from utils.label_codec import LABEL_CODECS, mask_column
+
+JOURNAL_DB_PATH = "data/journal.db"
+JOURNAL_CSV_PATH = "data/journal_entries_v4.csv"
+
+JOURNAL_COLUMNS = [
+    "entry",
+    "current_state",
+    "desired_state",
+    "entry_date",
+    "entry_title",
+    "entry_content",
+    "mental_tendencies",
+    "emotions",
+    "key_topics",
+    "reflection_questions",
+    "sentiment",
+]
+LABEL_COLUMNS = ["emotions", "key_topics", "mental_tendencies"]
+# bitmask of each label column over its fixed vocabulary, see utils.label_codec
+MASK_COLUMNS = [mask_column(label_type) for label_type in LABEL_COLUMNS]
+
+# columns added after the first release, added in place to older stores
+_ADDED_COLUMNS = {
+    "sentiment": "REAL",
+    **{column: "INTEGER NOT NULL DEFAULT 0" for column in MASK_COLUMNS},
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    entry TEXT PRIMARY KEY,
+    current_state TEXT,
+    desired_state TEXT,
+    entry_date TEXT NOT NULL,
+    entry_title TEXT,
+    entry_content TEXT,
+    mental_tendencies TEXT,
+    emotions TEXT,
+    key_topics TEXT,
+    reflection_questions TEXT,
+    sentiment REAL,
+    emotions_mask INTEGER NOT NULL DEFAULT 0,
+    key_topics_mask INTEGER NOT NULL DEFAULT 0,
+    mental_tendencies_mask INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_entry_date ON entries (entry_date);
+CREATE INDEX IF NOT EXISTS entries_unscored ON entries (entry) WHERE sentiment IS NULL;
+
+CREATE TABLE IF NOT EXISTS entry_labels (
+    entry TEXT NOT NULL REFERENCES entries (entry),
+    label_type TEXT NOT NULL,
+    label TEXT NOT NULL,
+    entry_month TEXT NOT NULL,
+    PRIMARY KEY (entry, label_type, label)
+);
+CREATE INDEX IF NOT EXISTS entry_labels_label ON entry_labels (label_type, label);
+
+-- aggregates for the analytics page, kept up to date by the triggers below
+CREATE TABLE IF NOT EXISTS label_counts (
+    label_type TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (label_type, label)
+);
+CREATE TABLE IF NOT EXISTS monthly_label_counts (
+    entry_month TEXT NOT NULL,
+    label_type TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (label_type, entry_month, label)
+);
+
+CREATE TRIGGER IF NOT EXISTS entry_labels_insert AFTER INSERT ON entry_labels
+BEGIN
+    INSERT INTO label_counts (label_type, label, count) VALUES (NEW.label_type, NEW.label, 1)
+    ON CONFLICT (label_type, label) DO UPDATE SET count = count + 1;
+    INSERT INTO monthly_label_counts (entry_month, label_type, label, count)
+    VALUES (NEW.entry_month, NEW.label_type, NEW.label, 1)
+    ON CONFLICT (label_type, entry_month, label) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS entry_labels_delete AFTER DELETE ON entry_labels
+BEGIN
+    UPDATE label_counts SET count = count - 1
+    WHERE label_type = OLD.label_type AND label = OLD.label;
+    UPDATE monthly_label_counts SET count = count - 1
+    WHERE label_type = OLD.label_type AND entry_month = OLD.entry_month AND label = OLD.label;
+END;
+
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO store_meta (key, value) VALUES ('data_version', 0);
+"""
+
+# bumped whenever derived tables change shape, older stores get them rebuilt from entries
+_SCHEMA_VERSION = 4
+
+# entry date formats of older data besides "YYYY-MM-DD", e.g. "Jun 4, 2024" in the original
+# vector store
+LEGACY_DATE_FORMATS = ["%b %d, %Y", "%B %d, %Y"]
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+
+
+def parse_labels(value) -> List[str]:
+    """
+    Parses a label column into a list of labels. Older entries store a stringified python list,
+    e.g. "['Sadness', 'Hope']", newer ones may hold the raw comma or line separated llm output.
+    """
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [str(label).strip() for label in value if str(label).strip()]
+
+    value = str(value).strip()
+    try:
+        parsed = ast.literal_eval(value)
+        if isinstance(parsed, (list, tuple, set)):
+            return [str(label).strip() for label in parsed if str(label).strip()]
+    except (ValueError, SyntaxError):
+        pass
+
+    labels = []
+    for part in value.replace("\n", ",").split(","):
+        label = part.strip().strip("-*[]'\" ").strip()
+        if label:
+            labels.append(label)
+    return labels
+
+
+def parse_entry_date(value) -> Optional[str]:
+    """
+    Parses an entry date (or datetime) into "YYYY-MM-DD", None if it is missing or unparseable
+    """
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    value = str(value).strip()
+    try:
+        return date.fromisoformat(value[:10]).isoformat()
+    except ValueError:
+        pass
+    for date_format in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _init_db(conn: sqlite3.Connection, db_path: str, csv_path: Optional[str]):
+    with _init_lock:
+        if db_path in _initialized:
+            return
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        entry_columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if entry_columns and column not in entry_columns:
+                conn.execute(f"ALTER TABLE entries ADD COLUMN {column} {column_type}")
+        if schema_version < 4:
+            # older stores also counted labels outside the fixed vocabularies
+            conn.executescript(
+                """
+                DROP TABLE IF EXISTS entry_labels;
+                DROP TABLE IF EXISTS label_counts;
+                DROP TABLE IF EXISTS monthly_label_counts;
+                """
+            )
+        conn.executescript(_SCHEMA)
+        if schema_version < 4:
+            rows = [dict(row) for row in conn.execute("SELECT * FROM entries")]
+            _insert_labels(conn, rows)
+            conn.executemany(
+                f"UPDATE entries SET {', '.join(f'{c} = :{c}' for c in MASK_COLUMNS)} "
+                "WHERE entry = :entry",
+                [{"entry": row["entry"], **_label_masks(row)} for row in rows],
+            )
+            # the rebuilt aggregates invalidate everything cached for the old ones
+            conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'data_version'")
+        if schema_version < _SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.commit()
+        is_empty = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0
+        if is_empty and csv_path and os.path.exists(csv_path):
+            migrate_from_csv(csv_path, db_path, conn=conn)
+        _initialized.add(db_path)
+
+
+def get_connection(db_path: str = JOURNAL_DB_PATH, csv_path: Optional[str] = None):
+    """
+    Returns a connection to the journal store for the current thread. The schema is created the
+    first time a store is opened, and the journal csv is migrated into the default store (or from
+    csv_path, when given).
+    """
+    if csv_path is None and db_path == JOURNAL_DB_PATH:
+        csv_path = JOURNAL_CSV_PATH
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        connections[db_path] = conn
+
+    _init_db(conn, db_path, csv_path)
+    return conn
+
+
+def _label_masks(entry: Dict) -> Dict[str, int]:
+    return {
+        mask_column(label_type): LABEL_CODECS[label_type].encode(
+            parse_labels(entry.get(label_type))
+        )
+        for label_type in LABEL_COLUMNS
+    }
+
+
+def _entry_row(entry: Dict):
+    row = {column: entry.get(column) for column in JOURNAL_COLUMNS}
+    row["entry"] = str(row["entry"])
+    row.update(_label_masks(row))
+    for column in JOURNAL_COLUMNS:
+        if isinstance(row[column], (list, tuple)):
+            row[column] = str(list(row[column]))
+    return row
+
+
+def _insert_labels(conn: sqlite3.Connection, rows: List[Dict]):
+    """
+    Replaces the labels of the given entry rows, the aggregate tables follow through triggers.
+    Only labels of the fixed vocabularies are kept, so stray text of the tagger output (e.g. a
+    "Mental tendencies:" heading) never shows up in the aggregates.
+    """
+    labels = []
+    for row in rows:
+        masks = _label_masks(row)
+        for label_type in LABEL_COLUMNS:
+            for label in LABEL_CODECS[label_type].decode(masks[mask_column(label_type)]):
+                labels.append((row["entry"], label_type, label, str(row["entry_date"])[:7]))
+
+    conn.executemany("DELETE FROM entry_labels WHERE entry = ?", [(row["entry"],) for row in rows])
+    conn.executemany(
+        "INSERT OR IGNORE INTO entry_labels (entry, label_type, label, entry_month) "
+        "VALUES (?, ?, ?, ?)",
+        labels,
+    )
+
+
+def _insert_entries(conn: sqlite3.Connection, entries: List[Dict], replace: bool = False):
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    columns = JOURNAL_COLUMNS + MASK_COLUMNS
+    placeholders = ", ".join(f":{column}" for column in columns)
+    query = f"{verb} INTO entries ({', '.join(columns)}) VALUES ({placeholders})"
+
+    written_rows = []
+    for row in map(_entry_row, entries):
+        if conn.execute(query, row).rowcount:
+            written_rows.append(row)
+
+    _insert_labels(conn, written_rows)
+    conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'data_version'")
+
+
+def migrate_from_csv(
+    csv_path: str = JOURNAL_CSV_PATH, db_path: str = JOURNAL_DB_PATH, conn=None
+) -> int:
+    """
+    One-shot import of the journal csv into the store, scoring the sentiment of entries that have
+    none. Entries already in the store are kept.
+    """
+    # imported here, utils.sentiment depends on this module
+    from utils.sentiment import score_sentiment
+
+    conn = conn or get_connection(db_path, csv_path)
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        entries = [row for row in csv.DictReader(f) if row.get("entry")]
+    for entry in entries:
+        if entry.get("sentiment") in (None, ""):
+            entry["sentiment"] = score_sentiment(entry.get("entry_content"))
+
+    with conn:
+        _insert_entries(conn, entries)
+    return len(entries)
+
+
+def add_entry(entry: Dict, db_path: str = JOURNAL_DB_PATH):
+    """
+    Adds a single entry (and its labels) to the store
+    """
+    conn = get_connection(db_path)
+    with conn:
+        _insert_entries(conn, [entry])
+
+
+def update_entries(entries: List[Dict], db_path: str = JOURNAL_DB_PATH):
+    """
+    Replaces the given entries in a single transaction
+    """
+    conn = get_connection(db_path)
+    with conn:
+        _insert_entries(conn, entries, replace=True)
+
+
+def update_sentiments(sentiments: Dict[str, float], db_path: str = JOURNAL_DB_PATH):
+    """
+    Stores sentiment scores by entry id without rewriting the rest of the entries
+    """
+    conn = get_connection(db_path)
+    with conn:
+        conn.executemany(
+            "UPDATE entries SET sentiment = ? WHERE entry = ?",
+            [(sentiment, str(entry_id)) for entry_id, sentiment in sentiments.items()],
+        )
+        conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'data_version'")
+
+
+def read_unscored_entries(db_path: str = JOURNAL_DB_PATH) -> pd.DataFrame:
+    """
+    Entries that have no sentiment score yet, e.g. imported from the csv
+    """
+    return pd.read_sql_query(
+        "SELECT entry, entry_content FROM entries WHERE sentiment IS NULL",
+        get_connection(db_path),
+    )
+
+
+def has_unscored_entries(db_path: str = JOURNAL_DB_PATH) -> bool:
+    """
+    Whether any entry has no sentiment score yet, answered from the entries_unscored index
+    """
+    conn = get_connection(db_path)
+    query = "SELECT EXISTS (SELECT 1 FROM entries WHERE sentiment IS NULL)"
+    return bool(conn.execute(query).fetchone()[0])
+
+
+def get_data_version(db_path: str = JOURNAL_DB_PATH) -> int:
+    """
+    Counter that increases on every write to the store, useful as a cache key
+    """
+    conn = get_connection(db_path)
+    return conn.execute("SELECT value FROM store_meta WHERE key = 'data_version'").fetchone()[0]
+
+
+def _where_clause(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    labels: Optional[Dict[str, List[str]]] = None,
+):
+    clauses, params = [], []
+    if start_date:
+        clauses.append("entry_date >= ?")
+        params.append(str(start_date))
+    if end_date:
+        clauses.append("entry_date <= ?")
+        params.append(str(end_date))
+    for label_type, label_values in (labels or {}).items():
+        if label_type not in LABEL_CODECS:
+            raise ValueError(f"Unknown label type: {label_type}")
+        # labels are matched on the bitmask column of their fixed vocabulary
+        required = LABEL_CODECS[label_type].mask_of(label_values)
+        clauses.append(f"({mask_column(label_type)} & ?) = ?")
+        params.extend([required, required])
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def read_entries(
+    columns: Optional[List[str]] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    labels: Optional[Dict[str, List[str]]] = None,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    descending: bool = False,
+    db_path: str = JOURNAL_DB_PATH,
+) -> pd.DataFrame:
+    '''
+    Input
+    -----
+    columns: the journal columns to load, defaults to all of them. The label bitmask columns
+        (MASK_COLUMNS) can be requested as well.
+    start_date / end_date: inclusive "YYYY-MM-DD" bounds on entry_date
+    labels: only keep entries tagged with all of the given labels, e.g. {"emotions": ["Fear"]},
+        labels outside the fixed vocabularies raise a ValueError
+    limit / offset: page through the results ordered by entry_date
+
+    Output
+    -----
+    A DataFrame with the requested columns
+    '''
+    columns = columns or JOURNAL_COLUMNS
+    unknown_columns = set(columns) - set(JOURNAL_COLUMNS + MASK_COLUMNS)
+    if unknown_columns:
+        raise ValueError(f"Unknown journal columns: {sorted(unknown_columns)}")
+
+    where, params = _where_clause(start_date, end_date, labels)
+    query = (
+        f"SELECT {', '.join(columns)} FROM entries {where} "
+        f"ORDER BY entry_date {'DESC' if descending else 'ASC'}, entry"
+    )
+    if limit is not None:
+        query += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+    return pd.read_sql_query(query, get_connection(db_path), params=params)
+
+
+def count_entries(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    labels: Optional[Dict[str, List[str]]] = None,
+    db_path: str = JOURNAL_DB_PATH,
+) -> int:
+    where, params = _where_clause(start_date, end_date, labels)
+    conn = get_connection(db_path)
+    return conn.execute(f"SELECT COUNT(*) FROM entries {where}", params).fetchone()[0]
+
+
+def get_entry_stats(db_path: str = JOURNAL_DB_PATH) -> Dict:
+    conn = get_connection(db_path)
+    num_entries, latest_entry_date = conn.execute(
+        "SELECT COUNT(*), MAX(entry_date) FROM entries"
+    ).fetchone()
+    return {"num_entries": num_entries, "latest_entry_date": latest_entry_date}
+
+
+def get_label_counts(label_type: str, db_path: str = JOURNAL_DB_PATH) -> pd.DataFrame:
+    """
+    Number of entries tagged with each label of label_type, most frequent first
+    """
+    return pd.read_sql_query(
+        "SELECT label, count FROM label_counts WHERE label_type = ? AND count > 0 "
+        "ORDER BY count DESC, label",
+        get_connection(db_path),
+        params=[label_type],
+    )
+
+
+def get_monthly_label_counts(label_type: str, db_path: str = JOURNAL_DB_PATH) -> pd.DataFrame:
+    """
+    Number of entries tagged with each label of label_type per "YYYY-MM" month
+    """
+    return pd.read_sql_query(
+        "SELECT entry_month, label, count FROM monthly_label_counts "
+        "WHERE label_type = ? AND count > 0 ORDER BY entry_month, label",
+        get_connection(db_path),
+        params=[label_type],
+    )
+
+
+def get_label_masks(
+    start_date: Optional[str] = None, end_date: Optional[str] = None, db_path: str = JOURNAL_DB_PATH
+) -> pd.DataFrame:
+    """
+    entry, entry_date and the label bitmask columns, for counting, co-occurrence and filtering
+    with the vectorized helpers of utils.label_codec
+    """
+    return read_entries(
+        columns=["entry", "entry_date"] + MASK_COLUMNS,
+        start_date=start_date,
+        end_date=end_date,
+        db_path=db_path,
+    )
+
+
+def get_entry(entry_id: str, db_path: str = JOURNAL_DB_PATH) -> Optional[Dict]:
+    conn = get_connection(db_path)
+    row = conn.execute("SELECT * FROM entries WHERE entry = ?", (str(entry_id),)).fetchone()
+    return dict(row) if row is not None else None
+
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate_from_csv()} entries from {JOURNAL_CSV_PATH} into {JOURNAL_DB_PATH}")
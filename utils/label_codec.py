@@ -0,0 +1,80 @@
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from old_diary_entries import emotions, key_topics, mental_tendencies
+
+
+class LabelCodec:
+    """
+    Encodes a set of labels from a small fixed vocabulary as an integer bitmask, bit i being set
+    when the i-th label of the vocabulary is present. Labels outside the vocabulary are dropped.
+    """
+
+    def __init__(self, vocabulary: List[str]):
+        if len(vocabulary) > 63:
+            raise ValueError("A label vocabulary can hold at most 63 labels")
+        self.vocabulary = list(vocabulary)
+        self._bits = {label.lower(): 1 << i for i, label in enumerate(self.vocabulary)}
+        self._bit_values = np.array([1 << i for i in range(len(self.vocabulary))], dtype=np.int64)
+
+    def encode(self, labels: Iterable[str]) -> int:
+        mask = 0
+        for label in labels:
+            mask |= self._bits.get(str(label).strip().lower(), 0)
+        return mask
+
+    def decode(self, mask: int) -> List[str]:
+        return [label for i, label in enumerate(self.vocabulary) if int(mask) >> i & 1]
+
+    def mask_of(self, labels: Iterable[str]) -> int:
+        """
+        Like encode, but raises for labels outside the vocabulary, for building filters
+        """
+        unknown = [label for label in labels if str(label).strip().lower() not in self._bits]
+        if unknown:
+            raise ValueError(f"Unknown labels: {unknown}")
+        return self.encode(labels)
+
+    def one_hot(self, masks) -> np.ndarray:
+        """
+        (number of masks, vocabulary size) boolean matrix
+        """
+        masks = np.asarray(masks, dtype=np.int64)
+        return (masks[:, None] & self._bit_values) != 0
+
+    def count(self, masks) -> pd.Series:
+        """
+        Number of masks each label is set in, most frequent first
+        """
+        counts = self.one_hot(masks).sum(axis=0)
+        return pd.Series(counts, index=self.vocabulary).sort_values(ascending=False)
+
+    def cooccurrence(self, masks) -> pd.DataFrame:
+        """
+        Label by label matrix of how many masks have both labels, the diagonal being the counts
+        """
+        one_hot = self.one_hot(masks).astype(np.int64)
+        return pd.DataFrame(one_hot.T @ one_hot, index=self.vocabulary, columns=self.vocabulary)
+
+    def filter(self, masks, labels: Iterable[str], match_all: bool = True) -> np.ndarray:
+        """
+        Boolean array of the masks that have all (or with match_all=False any) of the labels
+        """
+        masks = np.asarray(masks, dtype=np.int64)
+        required = self.mask_of(labels)
+        if match_all:
+            return (masks & required) == required
+        return (masks & required) != 0
+
+
+LABEL_CODECS: Dict[str, LabelCodec] = {
+    "emotions": LabelCodec(emotions),
+    "key_topics": LabelCodec(key_topics),
+    "mental_tendencies": LabelCodec(mental_tendencies),
+}
+
+
+def mask_column(label_type: str) -> str:
+    return f"{label_type}_mask"
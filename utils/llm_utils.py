@@ -1,45 +1,192 @@
-import json
 import os
+import threading
+import time
+from functools import lru_cache
 from typing import Dict
 
 import google.generativeai as genai
-import pandas as pd
 from dotenv import load_dotenv
 from langchain.chains import LLMChain
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI
 
 import utils.journal_query as jq
+import utils.journal_shards as journal_shards
 import utils.prompt_templates as pt
-from parse_sahha_score import main
+from utils.prompt_assembler import (
+    HISTORY_TOKEN_BUDGET,
+    PROMPT_TOKEN_BUDGET,
+    SECTION_BUDGET_SHARES,
+    count_tokens,
+)
 from utils.prompt_templates import *
+from utils.sahha_store import get_sahha_store
+from utils.sahha_trends import get_factor_trends, render_trend_insights
+from utils.user_partitions import SAHHA_USER_ID
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+SIMILAR_ISSUES_TOKEN_BUDGET = int(PROMPT_TOKEN_BUDGET * SECTION_BUDGET_SHARES["similar_issues"])
 
-def get_db_context(user_chat):
-    embeddings = GoogleGenerativeAIEmbeddings(
-        model="models/text-embedding-004"
-    )  # this should be abstracted later
-    db = jq.get_db(embeddings)
-    
+
+def get_db_context(user_chat, max_tokens=SIMILAR_ISSUES_TOKEN_BUDGET, index_path=jq.INDEX_PATH):
     ## Commenting out for now, just going to do a search with the user's chat input
     # prompt = pt.get_topics_from_user_chat()
     # model = ChatGoogleGenerativeAI(model='gemini-pro')
     # chain = LLMChain(llm=model, prompt=prompt)
     # topics = chain.run({"user_chat": user_chat})
 
-    docs, sims = jq.get_docs_with_query(db, user_chat, num_of_docs=4, score_threshold=0)
-    db_context_string = jq.format_docs(docs, sims)
+    docs, sims = journal_shards.search_shards(user_chat, num_of_docs=4, index_path=index_path)
+    db_context_string = jq.format_docs(docs, sims, max_tokens=max_tokens)
     return db_context_string
 
 
-def get_llm_instance():
-    model = genai.GenerativeModel("gemini-1.5-flash")
+@lru_cache(maxsize=32)
+def get_llm_instance(system_instruction=None):
+    """
+    Shared model per system instruction. All models use the process-wide genai client, so this
+    only caches the lightweight model wrapper.
+    """
+    model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=system_instruction)
     # model = genai.GenerativeModel("gemini-1.0-pro")
     return model
 
 
+class ConversationSession:
+    """
+    Owns the history of a conversation with the therapist model.
+
+    The system prompt is passed to the model as a system instruction rather than stored in the
+    history, so swapping it only replaces a string and keeps the same history list. Once the
+    history grows past history_token_budget, the oldest turns are folded into a running summary
+    that is sent along with the system instruction.
+    """
+
+    def __init__(self, system_prompt: str, history_token_budget: int = HISTORY_TOKEN_BUDGET):
+        self.system_prompt = system_prompt
+        self.history_token_budget = history_token_budget
+        self.summary = ""
+        self.history = []
+
+    def set_system_prompt(self, system_prompt: str):
+        self.system_prompt = system_prompt
+
+    def _system_instruction(self):
+        if not self.summary:
+            return self.system_prompt
+        return f"""
+{self.system_prompt}
+
+Summary of the earlier conversation with the user:
+```
+{self.summary}
+```
+        """.strip()
+
+    def _model(self):
+        return get_llm_instance(self._system_instruction())
+
+    def _history_tokens(self):
+        return sum(count_tokens(text) for _, text in self.messages())
+
+    def _compact_history(self):
+        """
+        Summarizes the oldest turns once the history is over budget, keeping the most recent
+        turns that fit in half of the budget
+        """
+        if self._history_tokens() <= self.history_token_budget:
+            return
+
+        kept_tokens, keep_from = 0, len(self.history)
+        for i in range(len(self.history) - 2, -1, -2):
+            turn_tokens = sum(count_tokens(msg["parts"][0]) for msg in self.history[i : i + 2])
+            if kept_tokens + turn_tokens > self.history_token_budget // 2:
+                break
+            kept_tokens += turn_tokens
+            keep_from = i
+
+        old_turns = "".join(
+            f"{msg['role']}: {msg['parts'][0]} \n\n" for msg in self.history[:keep_from]
+        )
+        prompt = f"""
+Summarize the following conversation between a user and a therapist in one paragraph.
+Keep the feelings, events and goals the user mentioned.
+```
+{self.summary}
+
+{old_turns}
+```
+        """.strip()
+
+        self.summary = get_completion(get_llm_instance(), prompt)
+        del self.history[:keep_from]
+
+    def send_message(self, user_msg: str, stream: bool = False):
+        """
+        Sends user_msg with the whole history and returns the reply text. With stream=True a
+        generator of text chunks is returned instead, user_msg and the reply are added to the
+        history once the generator ends.
+        """
+        self._compact_history()
+        self.history.append({"role": "user", "parts": [user_msg]})
+        try:
+            response = self._model().generate_content(self.history, stream=stream)
+        except Exception:
+            self.history.pop()
+            raise
+
+        if stream:
+            # committed together with the reply, see _stream_reply
+            return self._stream_reply(self.history.pop(), response)
+
+        self.history.append({"role": "model", "parts": [response.text]})
+        return response.text
+
+    def _stream_reply(self, user_turn, response):
+        """
+        Yields the reply chunks. The user turn and the reply are added to the history together,
+        so however the generator ends (exhausted, failed, or closed early e.g. when Streamlit
+        reruns mid stream) the turns stay paired: a partial reply is kept with its user turn, and
+        a user turn without any reply is left out.
+        """
+        reply = ""
+        try:
+            for chunk in response:
+                reply += chunk.text
+                yield chunk.text
+        finally:
+            if reply:
+                self.history += [user_turn, {"role": "model", "parts": [reply]}]
+
+    def rewind(self):
+        """
+        Removes the last user message and reply from the history and returns them
+        """
+        return self.history.pop(-2), self.history.pop()
+
+    def messages(self, role=None):
+        """
+        (role, text) pairs of the history, optionally only the ones from role
+        """
+        return [
+            (msg["role"], msg["parts"][0])
+            for msg in self.history
+            if role is None or msg["role"] == role
+        ]
+
+    def token_usage(self):
+        """
+        Approximate tokens sent with the next message, per section
+        """
+        usage = {
+            "system_prompt": count_tokens(self.system_prompt),
+            "summary": count_tokens(self.summary),
+            "history": self._history_tokens(),
+        }
+        usage["total"] = sum(usage.values())
+        return usage
+
+
 def get_completion(model, prompt):
     response = model.generate_content(prompt)
     return response.text
@@ -50,34 +197,38 @@ async def async_get_completion(model, prompt):
     return response.text
 
 
-def get_sahha_insights(date_time, user_id):
+class RateLimiter:
     """
-    Integration of Sahha API is not possible now so as aligned, we have retrieved a static json file
-    for a given day from the Sahha team. We assume user_id to be 4 and the output is from a given day.
+    Spaces out calls across threads so that at most calls_per_minute of them start per minute
     """
-    user_id = 4  # hard-coded
-    random_user_json, dic = main()
-
-    with open("data/sahha_metadata_flatten.json") as f:
-        md = json.load(f)
 
-    lst1 = dic["activity_scores"]
-    lst2 = dic["sleep_scores"]
-    factor_lst = lst1 + lst2
+    def __init__(self, calls_per_minute: float):
+        self.interval = 60.0 / calls_per_minute
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
 
-    factors_df = pd.DataFrame(factor_lst)  # sophie_dic['factors'])
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
 
-    lacking_df = factors_df[factors_df["state"] == "low"]
-    lacking_df["metadata"] = lacking_df["name"].map(md)
 
-    lacking_df["prompt"] = lacking_df.apply(
-        lambda x: f"For {x['name']}, {x['metadata']}, you're at {x['value']} {x['unit']}, "
-        f"which is {x['state']}, compared to the average of {x['score']} {x['unit']}.",
-        axis=1,
-    )
+def get_sahha_insights(date_time, user_id=SAHHA_USER_ID):
+    """
+    Integration of Sahha API is not possible now so as aligned, we have retrieved a static json file
+    for a given day from the Sahha team. user_id is the user's Sahha id (see UserPartition), users
+    without Sahha data get no insights.
+    """
+    if user_id is None:
+        return "", None
 
-    sahha_prompt = " ".join(lacking_df["prompt"].tolist())
+    sahha_prompt, well_being_score = get_sahha_store().get_insights(user_id)
 
-    well_being_score = dic["user"]["score"]
+    profile_id, _, _ = get_sahha_store().resolve(user_id)
+    trend_insights = render_trend_insights(get_factor_trends(), profile_id)
+    if trend_insights:
+        sahha_prompt = f"{sahha_prompt} {trend_insights}".strip()
 
     return sahha_prompt, well_being_score
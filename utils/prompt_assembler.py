@@ -0,0 +1,75 @@
+import os
+from typing import Dict, Tuple
+
+from utils.prompt_templates import get_chatbot_system_prompt
+
+# rough number of characters per token for english text, close enough for budgeting
+CHARS_PER_TOKEN = 4
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+
+# share of the system prompt budget each section may use before it gets truncated
+SECTION_BUDGET_SHARES = {"sahha_insights": 0.25, "similar_issues": 0.6}
+
+
+def count_tokens(text) -> int:
+    """
+    Approximate token count, avoids a count_tokens round trip to the model for every section
+    """
+    if not text:
+        return 0
+    return -(-len(str(text)) // CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens: int) -> str:
+    text = str(text)
+    if count_tokens(text) <= max_tokens:
+        return text
+    return text[: max(0, max_tokens * CHARS_PER_TOKEN - 3)].rstrip() + "..."
+
+
+def assemble_chatbot_system_prompt(
+    additional_info: str = "- The emotions that this person experienced",
+    sahha_insights: str = "",
+    similar_issues: str = "",
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+) -> Tuple[str, Dict[str, int]]:
+    '''
+    Builds the chatbot system prompt within token_budget.
+
+    Input
+    -----
+    additional_info, sahha_insights, similar_issues: same as get_chatbot_system_prompt
+    token_budget: approximate maximum number of tokens for the whole system prompt
+
+    Output
+    -----
+    prompt: the system prompt
+    usage: approximate tokens used by each section and in total
+    '''
+    for name, section in [("sahha_insights", sahha_insights), ("similar_issues", similar_issues)]:
+        if section is not None and not isinstance(section, str):
+            raise TypeError(f"{name} must be a str, not {type(section).__name__}")
+
+    sahha_insights = truncate_to_tokens(
+        sahha_insights or "", int(token_budget * SECTION_BUDGET_SHARES["sahha_insights"])
+    )
+    similar_issues = truncate_to_tokens(
+        similar_issues or "", int(token_budget * SECTION_BUDGET_SHARES["similar_issues"])
+    )
+
+    prompt = get_chatbot_system_prompt(
+        additional_info=additional_info,
+        sahha_insights=sahha_insights,
+        similar_issues=similar_issues,
+    )
+
+    usage = {
+        "sahha_insights": count_tokens(sahha_insights),
+        "similar_issues": count_tokens(similar_issues),
+        "additional_info": count_tokens(additional_info),
+    }
+    usage["instructions"] = max(0, count_tokens(prompt) - sum(usage.values()))
+    usage["total"] = count_tokens(prompt)
+    return prompt, usage
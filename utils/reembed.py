@@ -0,0 +1,40 @@
+import sys
+import time
+
+import utils.journal_query as jq
+import utils.journal_shards as journal_shards
+from utils.embeddings import EMBEDDING_BACKEND, get_embeddings
+from utils.user_partitions import DEFAULT_USER_ID, get_user_partition
+
+
+def reembed_index(index_path: str = jq.INDEX_PATH) -> int:
+    """
+    Re-embeds every document of the sharded index at index_path with the configured embedding
+    backend (EMBEDDING_BACKEND), keeping the documents and their metadata. Returns the number of
+    documents re-embedded.
+    """
+    manifest = journal_shards.read_manifest(index_path)
+    documents = []
+    for key in manifest["shards"]:
+        db = jq.get_db(index_path=journal_shards.shard_path(key, index_path))
+        documents += [
+            db.docstore.search(db.index_to_docstore_id[position])
+            for position in range(db.index.ntotal)
+        ]
+
+    if documents:
+        journal_shards.rebuild_shards(
+            documents, get_embeddings(), index_path, manifest["granularity"]
+        )
+    return len(documents)
+
+
+if __name__ == "__main__":
+    for user_id in sys.argv[1:] or [DEFAULT_USER_ID]:
+        index_path = get_user_partition(user_id).index_path
+        start = time.perf_counter()
+        count = reembed_index(index_path)
+        print(
+            f"Re-embedded {count} documents of {index_path} with the {EMBEDDING_BACKEND} backend "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+from typing import Tuple, Union
+
+from parse_sahha_score import get_user_details, sahha_scores_path
+
+SAHHA_METADATA_PATH = "data/sahha_metadata_flatten.json"
+
+
+def _file_version(*paths):
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+class SahhaStore:
+    """
+    Sahha scores parsed once and indexed by (profile id, date, score type). A profile has one
+    record per day for each score type ("wellbeing", "activity" and "sleep").
+
+    Rendered insight text is kept in memory and everything is rebuilt when the scores or the
+    factor metadata file changes on disk.
+    """
+
+    def __init__(
+        self, scores_path: str = sahha_scores_path, metadata_path: str = SAHHA_METADATA_PATH
+    ):
+        self.scores_path = scores_path
+        self.metadata_path = metadata_path
+        self._lock = threading.RLock()
+        self._version = None
+
+    def _ensure_loaded(self):
+        version = self.data_version()
+        if version == self._version:
+            return
+
+        with open(self.metadata_path) as f:
+            self.factor_metadata = json.load(f)
+
+        self.records = []
+        self.scores_by_user_date = {}
+        for user, activity_scores, sleep_scores in get_user_details(self.scores_path):
+            date = user_date(user)
+            self.records.append((user.profileId, date, user.type))
+            self.scores_by_user_date[(user.profileId, date, user.type)] = (
+                user,
+                sorted(activity_scores, key=lambda factor: factor.name),
+                sorted(sleep_scores, key=lambda factor: factor.name),
+            )
+
+        self.dates_by_user = {}
+        for profile_id, date, _ in self.scores_by_user_date:
+            self.dates_by_user.setdefault(profile_id, set()).add(date)
+        self.dates_by_user = {
+            profile_id: sorted(dates) for profile_id, dates in self.dates_by_user.items()
+        }
+
+        self._insights = {}
+        self._version = version
+
+    def data_version(self):
+        """
+        Fingerprint of the scores and factor metadata files, changes whenever either is rewritten
+        """
+        return _file_version(self.scores_path, self.metadata_path)
+
+    def resolve(
+        self, user_id: Union[int, str], date: str = None, score_type: str = "wellbeing"
+    ) -> Tuple[str, str, str]:
+        """
+        Maps a user id to a (profile id, date, score type) key. An integer user id is the
+        position of the record in the scores file, a string is a Sahha profile id. Without a
+        date the user's latest day is used.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if isinstance(user_id, int):
+                profile_id, record_date, record_type = self.records[user_id]
+                return profile_id, date or record_date, record_type
+            return user_id, date or self.dates_by_user[user_id][-1], score_type
+
+    def get_scores(self, user_id: Union[int, str], date: str = None):
+        """
+        (SahhaUser, activity factors, sleep factors) for the user on the given day
+        """
+        key = self.resolve(user_id, date)
+        with self._lock:
+            return self.scores_by_user_date[key]
+
+    def get_insights(self, user_id: Union[int, str], date: str = None) -> Tuple[str, float]:
+        """
+        Insight text for the factors the user is low on, and the user's well being score
+        """
+        key = self.resolve(user_id, date)
+        with self._lock:
+            if key not in self._insights:
+                user, activity_scores, sleep_scores = self.scores_by_user_date[key]
+                sahha_prompt = " ".join(
+                    f"For {factor.name}, {self.factor_metadata.get(factor.name)}, "
+                    f"you're at {factor.value} {factor.unit}, which is {factor.state}, "
+                    f"compared to the average of {factor.score} {factor.unit}."
+                    for factor in activity_scores + sleep_scores
+                    if factor.state == "low"
+                )
+                self._insights[key] = (sahha_prompt, user.score)
+            return self._insights[key]
+
+
+def user_date(user) -> str:
+    """
+    Day ("YYYY-MM-DD") a Sahha score belongs to, in the user's local time
+    """
+    return (user.scoreDateTime or "")[:10]
+
+
+_sahha_store = None
+_sahha_store_lock = threading.Lock()
+
+
+def get_sahha_store() -> SahhaStore:
+    global _sahha_store
+    with _sahha_store_lock:
+        if _sahha_store is None:
+            _sahha_store = SahhaStore()
+    return _sahha_store
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sys
+from datetime import date
+from typing import Dict, Iterator
+
+import numpy as np
+
+from parse_sahha_score import sahha_scores_path
+
+SAHHA_TIMESERIES_PATH = "data/sahha_timeseries"
+# records buffered in memory before they are appended to the column files
+FLUSH_EVERY_RECORDS = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+STATE_CODES = {None: -1, "minimal": 0, "low": 1, "medium": 2, "high": 3}
+STATE_NAMES = {code: state for state, code in STATE_CODES.items()}
+
+# column name -> dtype of the per factor column files
+COLUMNS = {
+    "user": np.int32,
+    "day": np.int32,
+    "value": np.float32,
+    "score": np.float32,
+    "goal": np.float32,
+    "state": np.int8,
+}
+
+
+def iter_json_array(file_path: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Dict]:
+    """
+    Yields the objects of a top level json array one at a time, reading the file in chunks so
+    memory use does not depend on the size of the file
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+
+    with open(file_path, encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            position = 0
+
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if not started and position < len(buffer):
+                    if buffer[position] != "[":
+                        raise ValueError(f"{file_path} does not contain a json array")
+                    started = True
+                    position += 1
+                    continue
+                if position < len(buffer) and buffer[position] == "]":
+                    return
+                try:
+                    obj, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break
+                yield obj
+
+            buffer = buffer[position:]
+            if not chunk:
+                return
+
+
+def to_day(date_time: str) -> int:
+    """
+    Days since 1970-01-01 for an ISO date time, using its local date
+    """
+    return date.fromisoformat(date_time[:10]).toordinal() - date(1970, 1, 1).toordinal()
+
+
+def from_day(day: int) -> str:
+    return date.fromordinal(int(day) + date(1970, 1, 1).toordinal()).isoformat()
+
+
+def _record_bytes(record: Dict) -> bytes:
+    return json.dumps(record, sort_keys=True).encode("utf-8")
+
+
+def _as_float(value):
+    return np.nan if value is None else value
+
+
+class SahhaTimeSeriesStore:
+    """
+    Compact per factor time series of Sahha scores.
+
+    Every factor has one append-only binary file per column (user, day, value, score, goal,
+    state). Users are stored as small integer ids, mapped to Sahha profile ids in users.json,
+    and manifest.json records how many records of each ingested file have been written, with a
+    digest of those records, so an interrupted ingestion resumes where it stopped and a file that
+    was rewritten rather than appended to is ingested again from the start.
+    """
+
+    def __init__(self, store_path: str = SAHHA_TIMESERIES_PATH):
+        self.store_path = store_path
+        os.makedirs(store_path, exist_ok=True)
+        self.users = self._read_json("users.json", {})
+        self.manifest = self._read_json("manifest.json", {})
+
+    def _read_json(self, file_name: str, default):
+        path = os.path.join(self.store_path, file_name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_json(self, file_name: str, data):
+        path = os.path.join(self.store_path, file_name)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _column_path(self, factor: str, column: str):
+        return os.path.join(self.store_path, f"{factor}.{column}.bin")
+
+    def _user_index(self, profile_id: str) -> int:
+        if profile_id not in self.users:
+            self.users[profile_id] = len(self.users)
+        return self.users[profile_id]
+
+    def _resume_from(self, file_path: str, file_key: str):
+        """
+        Number of records of file_path that are already in the store and the digest of those
+        records. Starts again from the first record when the file no longer begins with the
+        records that were ingested, e.g. a new export written to the same path.
+        """
+        done = self.manifest.get(file_key)
+        digest = hashlib.sha256()
+        # entries written before digests were recorded only hold a count and can't be checked
+        if not isinstance(done, dict) or not done["records"]:
+            return 0, digest
+
+        records = 0
+        for record in iter_json_array(file_path):
+            if records == done["records"]:
+                break
+            digest.update(_record_bytes(record))
+            records += 1
+        if records == done["records"] and digest.hexdigest() == done["sha256"]:
+            return records, digest
+        print(f"{file_path} changed since it was ingested, ingesting it again")
+        return 0, hashlib.sha256()
+
+    def _flush(self, buffers: Dict[str, Dict[str, list]], file_key: str, records_done: int, digest):
+        for factor, columns in buffers.items():
+            for column, dtype in COLUMNS.items():
+                with open(self._column_path(factor, column), "ab") as f:
+                    np.asarray(columns[column], dtype=dtype).tofile(f)
+        buffers.clear()
+
+        self._write_json("users.json", self.users)
+        self.manifest[file_key] = {"records": records_done, "sha256": digest.hexdigest()}
+        self._write_json("manifest.json", self.manifest)
+
+    def ingest(self, file_path: str, flush_every: int = FLUSH_EVERY_RECORDS) -> int:
+        """
+        Streams a Sahha score export into the store. Records already ingested from this file are
+        skipped, so the same file can be passed again after an interruption or once it grows. A
+        file whose ingested records changed is ingested again, the re-ingested records replace
+        the old ones in load_factor. Returns the number of new records.
+        """
+        file_key = os.path.abspath(file_path)
+        records_done, digest = self._resume_from(file_path, file_key)
+        new_records = 0
+        buffers = {}
+
+        for i, record in enumerate(iter_json_array(file_path)):
+            if i < records_done:
+                continue
+            digest.update(_record_bytes(record))
+
+            user = self._user_index(record["profileId"])
+            day = to_day(record["scoreDateTime"])
+            factors = record.get("factors") or []
+            # the overall score is stored like any other factor, named after the record type
+            overall_score = {
+                "name": record.get("type") or "wellbeing",
+                "value": record.get("score"),
+                "score": record.get("score"),
+                "goal": None,
+                "state": record.get("state"),
+            }
+
+            for factor in factors + [overall_score]:
+                columns = buffers.setdefault(factor["name"], {column: [] for column in COLUMNS})
+                columns["user"].append(user)
+                columns["day"].append(day)
+                columns["value"].append(_as_float(factor.get("value")))
+                columns["score"].append(_as_float(factor.get("score")))
+                columns["goal"].append(_as_float(factor.get("goal")))
+                columns["state"].append(STATE_CODES.get(factor.get("state"), -1))
+
+            new_records += 1
+            if new_records % flush_every == 0:
+                self._flush(buffers, file_key, i + 1, digest)
+
+        self._flush(buffers, file_key, records_done + new_records, digest)
+        return new_records
+
+    def factors(self):
+        suffix = ".user.bin"
+        return sorted(
+            file_name[: -len(suffix)]
+            for file_name in os.listdir(self.store_path)
+            if file_name.endswith(suffix)
+        )
+
+    def load_factor(self, factor: str) -> Dict[str, np.ndarray]:
+        """
+        Memory mapped columns of a factor. If the same user and day was ingested more than once,
+        only the last record is kept.
+        """
+        columns = {}
+        for column, dtype in COLUMNS.items():
+            path = self._column_path(factor, column)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                return {column: np.empty(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+            columns[column] = np.memmap(path, dtype=dtype, mode="r")
+
+        length = min(len(values) for values in columns.values())
+        keys = columns["user"][:length].astype(np.int64) << 32 | columns["day"][:length]
+        # index of the last occurrence of every (user, day)
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        keep = np.sort(length - 1 - last_reversed)
+        if len(keep) == length:
+            return {column: values[:length] for column, values in columns.items()}
+        return {column: np.asarray(values[:length])[keep] for column, values in columns.items()}
+
+
+if __name__ == "__main__":
+    store = SahhaTimeSeriesStore()
+    for file_path in sys.argv[1:] or [sahha_scores_path]:
+        print(f"Ingested {store.ingest(file_path)} new records from {file_path}")
@@ -0,0 +1,172 @@
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from parse_sahha_score import activity_factors, sahha_scores_path, sleep_factors
+from utils.sahha_timeseries import STATE_CODES, STATE_NAMES, SahhaTimeSeriesStore, from_day
+
+TREND_WINDOW_DAYS = 7
+
+
+def _rolling_nanmean(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Mean over the last `window` days for every (user, day), ignoring missing days
+    """
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0.0), axis=1)
+    counts = np.cumsum(valid, axis=1)
+    sums = np.concatenate([np.zeros((len(values), 1)), sums], axis=1)
+    counts = np.concatenate([np.zeros((len(values), 1)), counts], axis=1)
+
+    lagged = np.maximum(np.arange(1, values.shape[1] + 1) - window, 0)
+    window_sums = sums[:, 1:] - sums[:, lagged]
+    window_counts = counts[:, 1:] - counts[:, lagged]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+
+def _last_valid_index(values: np.ndarray) -> np.ndarray:
+    valid = ~np.isnan(values)
+    return values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+
+
+def _low_streak(states: np.ndarray, last_index: np.ndarray) -> np.ndarray:
+    """
+    Consecutive days in the low state, ending on each user's latest day with data
+    """
+    n_days = states.shape[1]
+    days_back = np.arange(n_days)[None, :]
+    day_index = last_index[:, None] - days_back
+    in_range = day_index >= 0
+    rows = np.arange(len(states))[:, None]
+    is_low = in_range & (states[rows, np.maximum(day_index, 0)] == STATE_CODES["low"])
+    return np.cumprod(is_low, axis=1).sum(axis=1)
+
+
+def compute_factor_trends(
+    store: SahhaTimeSeriesStore,
+    factors: Optional[Iterable[str]] = None,
+    window: int = TREND_WINDOW_DAYS,
+) -> pd.DataFrame:
+    '''
+    Input
+    -----
+    store: the Sahha time series store
+    factors: factor names to analyse, defaults to every activity and sleep factor
+    window: number of days in the rolling mean
+
+    Output
+    -----
+    One row per (user, factor) with the user's latest value and state, the difference to the
+    goal, the number of days in a row the factor has been low, and, as of the latest day in the
+    store, the rolling mean and its change against the week before.
+    '''
+    factors = sorted(factors or activity_factors | sleep_factors)
+    loaded = {factor: store.load_factor(factor) for factor in factors}
+    loaded = {factor: columns for factor, columns in loaded.items() if len(columns["day"])}
+    if not loaded:
+        return pd.DataFrame()
+
+    first_day = min(int(columns["day"].min()) for columns in loaded.values())
+    last_day = max(int(columns["day"].max()) for columns in loaded.values())
+    n_days = last_day - first_day + 1
+    n_users = len(store.users)
+    profile_ids = np.empty(n_users, dtype=object)
+    for profile_id, user in store.users.items():
+        profile_ids[user] = profile_id
+
+    frames = []
+    for factor, columns in loaded.items():
+        users = np.asarray(columns["user"])
+        days = np.asarray(columns["day"]) - first_day
+
+        values = np.full((n_users, n_days), np.nan)
+        values[users, days] = columns["value"]
+        goals = np.full((n_users, n_days), np.nan)
+        goals[users, days] = columns["goal"]
+        states = np.full((n_users, n_days), STATE_CODES[None], dtype=np.int8)
+        states[users, days] = columns["state"]
+
+        rolling_mean = _rolling_nanmean(values, window)
+        latest_rolling_mean = rolling_mean[:, -1]
+        previous_rolling_mean = (
+            rolling_mean[:, -1 - window] if n_days > window else np.full(n_users, np.nan)
+        )
+        rows = np.arange(n_users)
+        last_index = _last_valid_index(values)
+        latest_value = values[rows, last_index]
+        latest_goal = goals[rows, last_index]
+        latest_state = states[rows, last_index]
+        low_streak = _low_streak(states, last_index)
+
+        has_data = (~np.isnan(values)).any(axis=1)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "profile_id": profile_ids[has_data],
+                    "factor": factor,
+                    "category": "activity" if factor in activity_factors else "sleep",
+                    "latest_value": latest_value[has_data],
+                    "latest_state": [STATE_NAMES[s] for s in latest_state[has_data]],
+                    "goal": latest_goal[has_data],
+                    "delta_to_goal": (latest_value - latest_goal)[has_data],
+                    "rolling_mean": latest_rolling_mean[has_data],
+                    "week_over_week_change": (latest_rolling_mean - previous_rolling_mean)[
+                        has_data
+                    ],
+                    "low_streak_days": low_streak[has_data],
+                }
+            )
+        )
+
+    trends = pd.concat(frames, ignore_index=True)
+    trends["as_of"] = from_day(last_day)
+    return trends
+
+
+def render_trend_insights(trends: pd.DataFrame, profile_id: str) -> str:
+    """
+    Short text for the chatbot prompt about the factors the user is currently low in
+    """
+    if trends.empty:
+        return ""
+    user_trends = trends[
+        (trends["profile_id"] == profile_id)
+        & ((trends["low_streak_days"] > 0) | trends["latest_state"].isin(["low", "minimal"]))
+    ]
+
+    sentences = []
+    for row in user_trends.itertuples():
+        sentence = (
+            f"Your {row.factor} has averaged {row.rolling_mean:.1f} against a goal of {row.goal:g}"
+        )
+        if not np.isnan(row.week_over_week_change):
+            direction = "up" if row.week_over_week_change >= 0 else "down"
+            sentence += f", {direction} {abs(row.week_over_week_change):.1f} on the week before"
+        if row.low_streak_days > 1:
+            sentence += f", and has been low for {row.low_streak_days} days in a row"
+        sentences.append(sentence + ".")
+    return " ".join(sentences)
+
+
+_trends_cache = {}
+_trends_lock = threading.Lock()
+
+
+def get_factor_trends(scores_path: str = sahha_scores_path) -> pd.DataFrame:
+    """
+    Trends over the Sahha time series store, ingesting scores_path first when it changed.
+    The result is kept in memory until the scores file changes again.
+    """
+    stat = os.stat(scores_path)
+    version = (scores_path, stat.st_mtime_ns, stat.st_size)
+    with _trends_lock:
+        if _trends_cache.get("version") != version:
+            store = SahhaTimeSeriesStore()
+            store.ingest(scores_path)
+            _trends_cache["trends"] = compute_factor_trends(store)
+            _trends_cache["version"] = version
+        return _trends_cache["trends"]
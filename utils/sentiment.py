@@ -0,0 +1,49 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from textblob import TextBlob
+
+import utils.journal_store as js
+from utils.user_partitions import DEFAULT_USER_ID, get_user_partition
+
+# entries sent to a worker process at a time during the backfill
+SENTIMENT_CHUNK_SIZE = 64
+
+
+def score_sentiment(text: Optional[str]) -> float:
+    """
+    Polarity of the text between -1 (negative) and 1 (positive)
+    """
+    if not isinstance(text, str) or not text.strip():
+        return 0.0
+    return TextBlob(text).sentiment.polarity
+
+
+def backfill_sentiment(max_workers: Optional[int] = None, db_path: str = js.JOURNAL_DB_PATH) -> int:
+    """
+    Scores every stored entry that has no sentiment yet, spreading the work over a process pool
+    since TextBlob is CPU bound. Returns the number of entries scored.
+
+    Meant for stores created before sentiment was scored at ingest time, run it from the command
+    line (python -m utils.sentiment) rather than from a page, the pool forks the calling process.
+    """
+    unscored = js.read_unscored_entries(db_path=db_path)
+    if unscored.empty:
+        return 0
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        sentiments = list(
+            executor.map(
+                score_sentiment, unscored["entry_content"].tolist(), chunksize=SENTIMENT_CHUNK_SIZE
+            )
+        )
+
+    js.update_sentiments(dict(zip(unscored["entry"], sentiments)), db_path=db_path)
+    return len(sentiments)
+
+
+if __name__ == "__main__":
+    for user_id in sys.argv[1:] or [DEFAULT_USER_ID]:
+        db_path = get_user_partition(user_id).journal_db_path
+        print(f"Scored the sentiment of {backfill_sentiment(db_path=db_path)} entries in {db_path}")
@@ -1,8 +1,9 @@
 import streamlit as st
 
-from agent_chain import chat_with_user, get_llm_chat_instance
-from utils.prompt_templates import get_chatbot_system_prompt
+from agent_chain import chat_with_user, get_llm_chat_instance, stream_chat_with_user
+from utils.prompt_assembler import assemble_chatbot_system_prompt
 from utils.llm_utils import get_db_context, get_sahha_insights, get_llm_instance
+from utils.user_partitions import current_user_partition
 
 ## Streamlit related functions ##
 def get_custom_css_modifier():
@@ -30,6 +31,12 @@ def load_resources():
         st.session_state["conversation_labels"] = None
     if "chat_model" not in st.session_state:
         st.session_state["chat_model"] = None
+    if "steering_branch" not in st.session_state:
+        st.session_state["steering_branch"] = None
+    if "label_state" not in st.session_state:
+        st.session_state["label_state"] = None
+    if "prompt_token_usage" not in st.session_state:
+        st.session_state["prompt_token_usage"] = None
 
     return
 
@@ -38,14 +45,18 @@ def enable_explore_further():
     st.session_state["explore_further_enabled"] = True
 
     initial_entry = st.session_state["new_entry_text"]
+    partition = current_user_partition()
 
-    chat_model = get_llm_chat_instance(
-        get_chatbot_system_prompt(
-            sahha_insights=get_sahha_insights(1,1),
-            similar_issues=get_db_context(initial_entry)
-        )
+    sahha_prompt, _ = get_sahha_insights(1, partition.sahha_user_id)
+    system_prompt, prompt_token_usage = assemble_chatbot_system_prompt(
+        sahha_insights=sahha_prompt,
+        similar_issues=get_db_context(initial_entry, index_path=partition.index_path)
     )
+    st.session_state["prompt_token_usage"] = prompt_token_usage
+    chat_model = get_llm_chat_instance(system_prompt)
     st.session_state["chat_model"] = chat_model
+    st.session_state["steering_branch"] = "emotions"
+    st.session_state["label_state"] = None
     starting_message, conversation_labels = chat_with_user(initial_entry)
 
     st.session_state["conversation_labels"] = conversation_labels
@@ -0,0 +1,113 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import streamlit as st
+
+DEFAULT_USER_ID = "default"
+USERS_PATH = "data/users"
+
+# Sahha record used for the default user, the sample export has no link to app users
+SAHHA_USER_ID = 4
+# json object mapping app user ids to Sahha profile ids, e.g. '{"alex": "3f2c..."}'
+SAHHA_PROFILE_IDS = json.loads(os.getenv("SAHHA_PROFILE_IDS", "{}"))
+
+# secret the ?user= links are signed with (see user_link_query). Without it the user query
+# parameter is refused, and every session is the default user.
+USER_LINK_SECRET = os.getenv("USER_LINK_SECRET", "")
+
+_USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+@dataclass(frozen=True)
+class UserPartition:
+    """
+    Where one user's journal store, vector index and caches live
+    """
+
+    user_id: str
+    journal_db_path: str
+    index_path: str
+    analytics_cache_path: str
+    insights_cache_path: str
+    backfill_checkpoint_path: str
+    sahha_user_id: Optional[Union[int, str]]
+
+
+def get_user_partition(user_id: Optional[str] = None) -> UserPartition:
+    """
+    The default user keeps the original single user paths, every other user gets its own
+    directory under USERS_PATH
+    """
+    user_id = user_id or DEFAULT_USER_ID
+    if not _USER_ID_PATTERN.match(user_id):
+        raise ValueError(f"Invalid user id: {user_id!r}")
+
+    if user_id == DEFAULT_USER_ID:
+        return UserPartition(
+            user_id=user_id,
+            journal_db_path="data/journal.db",
+            index_path="faiss_index",
+            analytics_cache_path="data/analytics_cache",
+            insights_cache_path="data/insights_cache.json",
+            backfill_checkpoint_path="data/backfill_checkpoint.jsonl",
+            sahha_user_id=SAHHA_PROFILE_IDS.get(user_id, SAHHA_USER_ID),
+        )
+
+    user_path = os.path.join(USERS_PATH, user_id)
+    return UserPartition(
+        user_id=user_id,
+        journal_db_path=os.path.join(user_path, "journal.db"),
+        index_path=os.path.join(user_path, "faiss_index"),
+        analytics_cache_path=os.path.join(user_path, "analytics_cache"),
+        insights_cache_path=os.path.join(user_path, "insights_cache.json"),
+        backfill_checkpoint_path=os.path.join(user_path, "backfill_checkpoint.jsonl"),
+        sahha_user_id=SAHHA_PROFILE_IDS.get(user_id),
+    )
+
+
+def user_link_token(user_id: str, secret: str = USER_LINK_SECRET) -> str:
+    return hmac.new(secret.encode("utf-8"), user_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def user_link_query(user_id: str, secret: str = USER_LINK_SECRET) -> str:
+    """
+    Query string of the personal link of user_id, e.g. "?user=alex&token=3f2c..."
+    """
+    if not secret:
+        raise ValueError("Set USER_LINK_SECRET to sign user links")
+    get_user_partition(user_id)
+    return f"?user={user_id}&token={user_link_token(user_id, secret)}"
+
+
+def is_valid_user_link(user_id: str, token: str, secret: str = USER_LINK_SECRET) -> bool:
+    return bool(secret) and hmac.compare_digest(str(token), user_link_token(user_id, secret))
+
+
+def current_user_partition() -> UserPartition:
+    """
+    Partition of the user of the current Streamlit session, kept for the rest of the session.
+    The user comes from the ?user= query parameter, which is only accepted together with the
+    token signed for it with USER_LINK_SECRET (see user_link_query). A link with a missing or
+    wrong token stops the page rather than opening any journal.
+
+    This is not a login: whoever has a user's link can read their journal, so links must be
+    handed out privately, and deployments reachable by others belong behind real authentication.
+    """
+    if "user_partition" not in st.session_state:
+        user_id = st.query_params.get("user")
+        if user_id and not is_valid_user_link(user_id, st.query_params.get("token", "")):
+            st.error("This link is not valid, ask for a new personal link.")
+            st.stop()
+        st.session_state["user_partition"] = get_user_partition(user_id)
+    return st.session_state["user_partition"]
+
+
+if __name__ == "__main__":
+    for user_id in sys.argv[1:]:
+        print(f"{user_id}: {user_link_query(user_id)}")